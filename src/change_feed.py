@@ -0,0 +1,53 @@
+import os
+import json
+from datetime import datetime
+
+# Topic exchange replicas publish applied writes to, with routing keys of
+# the form "<keyspace>.replica<N>"
+CHANGE_FEED_EXCHANGE = "change_feed"
+
+
+def change_routing_key(keyspace, replica_id="*"):
+    """Routing key of the change events of a replica (or all replicas)"""
+    replica = replica_id if replica_id == "*" else f"replica{replica_id}"
+    return f"{keyspace}.{replica}"
+
+
+def change_event(replica_id, keyspace, line_number, content, watermark, version=0):
+    """Build the event published for a write applied by a replica"""
+    return {
+        "timestamp": datetime.now().isoformat(),
+        "replica": f"replica{replica_id}",
+        "keyspace": keyspace,
+        "line": line_number,
+        "content": content,
+        "watermark": watermark,
+        "version": version,
+    }
+
+
+def append_changes(directory, events):
+    """Append events to the replica's change history (`changes.log`).
+
+    The history is what subscribers resuming from a watermark are replayed
+    from. It is written after the data file is committed and is not fsynced,
+    so after a crash it may miss the last few events of the data file.
+    """
+    with open(f"{directory}/changes.log", "a") as f:
+        for event in events:
+            f.write(json.dumps(event) + "\n")
+
+
+def read_changes_since(directory, watermark):
+    """Yield the events of the change history with a newer watermark"""
+    file_path = f"{directory}/changes.log"
+    if not os.path.exists(file_path):
+        return
+    with open(file_path, "r") as f:
+        for line in f:
+            try:
+                event = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if event.get("watermark") is not None and event["watermark"] > watermark:
+                yield event
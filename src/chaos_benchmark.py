@@ -0,0 +1,388 @@
+"""Fault-injection benchmark for the replication system.
+
+Runs the replicas as local processes against a RabbitMQ broker, drives a
+steady read/write workload through the regular clients and, following a
+schedule, kills, pauses or slows replicas down. It reports client-observed
+latency percentiles and timeout rates per phase, the consensus outcomes of
+`read_all_lines` and how long each replica took to catch up after a fault.
+
+Example (with RabbitMQ listening on localhost):
+
+    python src/chaos_benchmark.py --duration 60 --output results.json
+
+The default schedule kills replica2 at 10 s (restarted 10 s later), pauses
+replica3 at 30 s for 8 s (a frozen process keeps its connection open but
+stops answering, like a network partition) and slows replica1 at 45 s by
+freezing it for 80 ms out of every 100 ms.
+"""
+
+import os
+import sys
+import json
+import time
+import signal
+import argparse
+import tempfile
+import threading
+import subprocess
+from collections import defaultdict
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# (start second, action, replica id, duration in seconds)
+DEFAULT_SCHEDULE = [
+    (10, "kill", 2, 10),
+    (30, "pause", 3, 8),
+    (45, "slow", 1, 8),
+]
+ACTIONS = ("kill", "pause", "partition", "slow")
+
+# Slow replicas are frozen for SLOW_STOP_MS out of every SLOW_PERIOD_MS
+SLOW_PERIOD_MS = 100
+SLOW_STOP_MS = 80
+
+
+def parse_schedule(spec):
+    """Parse "10:kill:2:10,30:pause:3:8" into schedule tuples"""
+    schedule = []
+    for item in spec.split(","):
+        start, action, replica_id, duration = item.split(":")
+        if action not in ACTIONS:
+            raise ValueError(f"Unknown action {action!r}, use one of {ACTIONS}")
+        schedule.append((float(start), action, int(replica_id), float(duration)))
+    return sorted(schedule)
+
+
+def percentile(samples, p):
+    if not samples:
+        return None
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(p * len(samples)))]
+
+
+class ReplicaProcesses:
+    """Start, kill, restart, pause and resume local replica processes"""
+
+    def __init__(self, replica_ids, env, log_dir):
+        self.replica_ids = replica_ids
+        self.env = env
+        self.log_dir = log_dir
+        self.processes = {}
+
+    def start(self, replica_id):
+        log_file = open(f"{self.log_dir}/replica{replica_id}.out", "a")
+        self.processes[replica_id] = subprocess.Popen(
+            [sys.executable, "-u", f"{SRC_DIR}/replica.py", str(replica_id)],
+            env=self.env,
+            stdout=log_file,
+            stderr=subprocess.STDOUT,
+        )
+
+    def start_all(self):
+        for replica_id in self.replica_ids:
+            self.start(replica_id)
+
+    def signal(self, replica_id, signum):
+        process = self.processes.get(replica_id)
+        if process is not None and process.poll() is None:
+            process.send_signal(signum)
+
+    def kill(self, replica_id):
+        self.signal(replica_id, signal.SIGKILL)
+        self.processes[replica_id].wait()
+
+    def stop_all(self):
+        for replica_id in self.processes:
+            self.signal(replica_id, signal.SIGCONT)
+            self.signal(replica_id, signal.SIGINT)
+        for process in self.processes.values():
+            try:
+                process.wait(timeout=15)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+
+class ChaosBenchmark:
+    def __init__(self, args):
+        self.args = args
+        self.schedule = args.schedule
+        self.replica_ids = list(range(1, args.replicas + 1))
+        self.stop_event = threading.Event()
+        self.lock = threading.Lock()
+        self.active_faults = set()
+        self.samples = []  # (phase, operation, latency or None on timeout)
+        self.consensus = []
+        self.recoveries = []
+        self.start_time = None
+
+        env = dict(os.environ, REPLICAS_DIR=args.data_dir)
+        env["RABBITMQ_HOST"] = args.rabbitmq_host
+        self.replicas = ReplicaProcesses(self.replica_ids, env, args.data_dir)
+
+        # The clients read their settings at import time, so they are only
+        # imported once the environment points at the benchmark's replicas
+        os.environ["REPLICAS_DIR"] = args.data_dir
+        os.environ["RABBITMQ_HOST"] = args.rabbitmq_host
+        from clientWriter import send_message
+        from clientReader import read_last_line
+        from clientReader_v2 import read_all_lines
+        from replication_lag import read_applied_watermark, read_stamped_watermarks
+
+        self.send_message = send_message
+        self.read_last_line = read_last_line
+        self.read_all_lines = read_all_lines
+        self.read_applied_watermark = read_applied_watermark
+        self.read_stamped_watermarks = read_stamped_watermarks
+
+    def phase(self):
+        with self.lock:
+            return ", ".join(sorted(self.active_faults)) or "healthy"
+
+    def record(self, operation, latency, phase):
+        with self.lock:
+            self.samples.append((phase, operation, latency))
+
+    def elapsed(self):
+        return time.time() - self.start_time
+
+    # ---- Workload ----
+
+    def write_loop(self):
+        line_number = 0
+        interval = 1.0 / self.args.write_rate
+        while not self.stop_event.is_set():
+            line_number += 1
+            phase = self.phase()
+            started = time.time()
+            try:
+                self.send_message(f"{line_number} chaos write {line_number}")
+                self.record("write", time.time() - started, phase)
+            except Exception as e:
+                print(f"Write {line_number} failed: {e}")
+                self.record("write", None, phase)
+            time.sleep(max(0.0, interval - (time.time() - started)))
+
+    def read_loop(self):
+        interval = 1.0 / self.args.read_rate
+        while not self.stop_event.is_set():
+            phase = self.phase()
+            started = time.time()
+            try:
+                result = self.read_last_line()
+                latency = time.time() - started if result["first_response"] else None
+            except Exception as e:
+                print(f"Read last failed: {e}")
+                latency = None
+            self.record("read_last", latency, phase)
+            time.sleep(max(0.0, interval - (time.time() - started)))
+
+    def consensus_loop(self):
+        while not self.stop_event.wait(self.args.consensus_interval):
+            phase = self.phase()
+            started = time.time()
+            try:
+                result = self.read_all_lines()
+            except Exception as e:
+                print(f"Read all failed: {e}")
+                self.record("read_all", None, phase)
+                continue
+            latency = time.time() - started
+            raw_data = result["raw_data"]
+            all_lines = set().union(*raw_data.values()) if raw_data else set()
+            self.record("read_all", latency, phase)
+            with self.lock:
+                self.consensus.append(
+                    {
+                        "at": round(self.elapsed(), 1),
+                        "phase": phase,
+                        "latency_s": latency,
+                        "majority_lines": len(result["majority_lines"]),
+                        "distinct_lines": len(all_lines),
+                        "lines_per_replica": {
+                            replica: len(lines) for replica, lines in raw_data.items()
+                        },
+                    }
+                )
+
+    # ---- Faults ----
+
+    def inject(self, action, replica_id, duration):
+        label = f"{action} replica{replica_id}"
+        print(f"[{self.elapsed():6.1f}s] {label} for {duration}s")
+        with self.lock:
+            self.active_faults.add(label)
+
+        if action == "kill":
+            self.replicas.kill(replica_id)
+            self.stop_event.wait(duration)
+            self.replicas.start(replica_id)
+        elif action in ("pause", "partition"):
+            self.replicas.signal(replica_id, signal.SIGSTOP)
+            self.stop_event.wait(duration)
+            self.replicas.signal(replica_id, signal.SIGCONT)
+        elif action == "slow":
+            until = time.time() + duration
+            while time.time() < until and not self.stop_event.is_set():
+                self.replicas.signal(replica_id, signal.SIGSTOP)
+                time.sleep(SLOW_STOP_MS / 1000)
+                self.replicas.signal(replica_id, signal.SIGCONT)
+                time.sleep((SLOW_PERIOD_MS - SLOW_STOP_MS) / 1000)
+
+        with self.lock:
+            self.active_faults.discard(label)
+        self.measure_recovery(label, replica_id)
+
+    def measure_recovery(self, label, replica_id):
+        """Time until the replica has applied every write made before it returned"""
+        target = self.read_stamped_watermarks()
+        target = target[-1] if target else 0
+        returned_at = time.time()
+        while not self.stop_event.is_set():
+            if self.read_applied_watermark(replica_id) >= target:
+                recovery = time.time() - returned_at
+                print(
+                    f"[{self.elapsed():6.1f}s] replica{replica_id} caught up in {recovery:.2f}s"
+                )
+                with self.lock:
+                    self.recoveries.append(
+                        {"fault": label, "recovery_s": recovery, "caught_up": True}
+                    )
+                return
+            time.sleep(0.1)
+        with self.lock:
+            self.recoveries.append(
+                {
+                    "fault": label,
+                    "recovery_s": time.time() - returned_at,
+                    "caught_up": False,
+                }
+            )
+
+    def run_schedule(self):
+        threads = []
+        for start, action, replica_id, duration in self.schedule:
+            if self.stop_event.wait(max(0.0, start - self.elapsed())):
+                break
+            thread = threading.Thread(
+                target=self.inject, args=(action, replica_id, duration), daemon=True
+            )
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+
+    # ---- Run and report ----
+
+    def run(self):
+        self.replicas.start_all()
+        time.sleep(self.args.warmup)
+        self.start_time = time.time()
+
+        workers = [
+            threading.Thread(target=self.write_loop, daemon=True),
+            threading.Thread(target=self.read_loop, daemon=True),
+            threading.Thread(target=self.consensus_loop, daemon=True),
+            threading.Thread(target=self.run_schedule, daemon=True),
+        ]
+        for worker in workers:
+            worker.start()
+        try:
+            time.sleep(self.args.duration)
+        finally:
+            self.stop_event.set()
+            for worker in workers:
+                worker.join(timeout=15)
+            self.replicas.stop_all()
+        return self.report()
+
+    def report(self):
+        grouped = defaultdict(list)
+        for phase, operation, latency in self.samples:
+            grouped[(phase, operation)].append(latency)
+
+        phases = []
+        for (phase, operation), latencies in sorted(grouped.items()):
+            succeeded = [latency for latency in latencies if latency is not None]
+            phases.append(
+                {
+                    "phase": phase,
+                    "operation": operation,
+                    "requests": len(latencies),
+                    "timeout_rate": 1 - len(succeeded) / len(latencies),
+                    "p50_ms": _ms(percentile(succeeded, 0.50)),
+                    "p95_ms": _ms(percentile(succeeded, 0.95)),
+                    "p99_ms": _ms(percentile(succeeded, 0.99)),
+                }
+            )
+
+        return {
+            "schedule": self.schedule,
+            "phases": phases,
+            "consensus": self.consensus,
+            "recoveries": self.recoveries,
+        }
+
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 1)
+
+
+def print_report(report):
+    print("\n=== LATENCY BY PHASE ===")
+    print(
+        f"{'phase':<28}{'operation':<11}{'reqs':>6}{'timeouts':>10}{'p50':>9}{'p95':>9}{'p99':>9}"
+    )
+    for row in report["phases"]:
+        print(
+            f"{row['phase']:<28}{row['operation']:<11}{row['requests']:>6}"
+            f"{row['timeout_rate']:>9.1%} {row['p50_ms']!s:>8} {row['p95_ms']!s:>8} "
+            f"{row['p99_ms']!s:>8}"
+        )
+
+    print("\n=== CONSENSUS READS ===")
+    for outcome in report["consensus"]:
+        print(
+            f"{outcome['at']:>6}s {outcome['phase']:<28} majority "
+            f"{outcome['majority_lines']}/{outcome['distinct_lines']} lines, "
+            f"per replica {outcome['lines_per_replica']}"
+        )
+
+    print("\n=== RECOVERY ===")
+    for recovery in report["recoveries"]:
+        status = "caught up" if recovery["caught_up"] else "still behind"
+        print(f"{recovery['fault']:<28}{status} after {recovery['recovery_s']:.2f}s")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--duration", type=float, default=60)
+    parser.add_argument("--replicas", type=int, default=3)
+    parser.add_argument(
+        "--schedule",
+        type=parse_schedule,
+        default=DEFAULT_SCHEDULE,
+        help="comma separated start:action:replica:duration, "
+        f"actions: {', '.join(ACTIONS)}",
+    )
+    parser.add_argument("--write-rate", type=float, default=20, help="writes/s")
+    parser.add_argument("--read-rate", type=float, default=10, help="reads/s")
+    parser.add_argument("--consensus-interval", type=float, default=5)
+    parser.add_argument("--warmup", type=float, default=3)
+    parser.add_argument("--rabbitmq-host", default="localhost")
+    parser.add_argument("--data-dir", default=None)
+    parser.add_argument("--output", default=None, help="write the report as JSON")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    args.data_dir = args.data_dir or tempfile.mkdtemp(prefix="chaos-replicas-")
+    print(f"Replica data and logs in {args.data_dir}")
+
+    report = ChaosBenchmark(args).run()
+    print_report(report)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nReport written to {args.output}")
@@ -0,0 +1,87 @@
+import pika
+import uuid
+import time
+import json
+from datetime import datetime
+from keyspaces import control_queue
+from deadlines import request_properties
+from settings import RABBITMQ_HOST, REPLICAS_DIR
+
+# Seconds to wait for a replica to answer a control command
+CONTROL_TIMEOUT = 5.0
+
+
+def log_client_operation(operation_type, content):
+    """Log client operations for the web UI"""
+    log_dir = REPLICAS_DIR
+    log_file = f"{log_dir}/client_operations.log"
+
+    log_entry = {
+        "timestamp": datetime.now().isoformat(),
+        "operation": operation_type,
+        "content": content,
+        "client": "client_control",
+    }
+
+    with open(log_file, "a") as f:
+        f.write(json.dumps(log_entry) + "\n")
+
+
+def send_control(replica_id, command, timeout=CONTROL_TIMEOUT, **arguments):
+    """Send a diagnostic command to a replica and return its answer"""
+    connection = pika.BlockingConnection(pika.ConnectionParameters(RABBITMQ_HOST))
+    channel = connection.channel()
+
+    # Create callback queue
+    result = channel.queue_declare(queue="", exclusive=True)
+    callback_queue = result.method.queue
+    correlation_id = str(uuid.uuid4())
+    response = {}
+
+    def on_response(ch, method, props, body):
+        if props.correlation_id == correlation_id:
+            response["body"] = json.loads(body)
+
+    channel.basic_consume(
+        queue=callback_queue, on_message_callback=on_response, auto_ack=True
+    )
+
+    # The command expires with this call, so a replica that was unreachable
+    # does not start a profiler long after the requester gave up
+    channel.basic_publish(
+        exchange="",
+        routing_key=control_queue(replica_id),
+        properties=request_properties(callback_queue, correlation_id, timeout),
+        body=json.dumps({"command": command, **arguments}),
+    )
+    log_client_operation("CONTROL", f"{command} sent to replica{replica_id}")
+
+    start_time = time.time()
+    while "body" not in response and time.time() - start_time < timeout:
+        connection.process_data_events(time_limit=0.1)
+    connection.close()
+
+    if "body" not in response:
+        raise TimeoutError(f"replica{replica_id} did not answer {command!r}")
+    return response["body"]
+
+
+def start_profiler(replica_id, interval=None):
+    """Start the sampling profiler of a replica"""
+    arguments = {} if interval is None else {"interval": interval}
+    return send_control(replica_id, "profile_start", **arguments)
+
+
+def stop_profiler(replica_id):
+    """Stop the profiler of a replica and return its profile"""
+    return send_control(replica_id, "profile_stop")
+
+
+def get_handler_timings(replica_id, reset=False):
+    """Return the per-handler timing counters of a replica"""
+    return send_control(replica_id, "timings", reset=reset)
+
+
+def get_memory_usage(replica_id):
+    """Return the memory usage of a replica"""
+    return send_control(replica_id, "memory")
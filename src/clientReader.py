@@ -2,12 +2,32 @@ import pika
 import uuid
 import time
 import json
+from collections import deque
 from datetime import datetime
+from replication_lag import replicas_within_lag
+from keyspaces import DEFAULT_KEYSPACE, read_queue
+from deadlines import request_properties
+from settings import RABBITMQ_HOST, REPLICAS_DIR
+
+# Smoothing factor of the per-replica EWMA read latency
+EWMA_ALPHA = 0.2
+# Latency estimates older than this (seconds) are forgotten
+EWMA_RESET_AFTER = 30.0
+# Percentile of recent read latencies used as the hedging deadline
+HEDGE_PERCENTILE = 0.95
+# Hedging deadline (seconds) used until enough samples are collected
+DEFAULT_HEDGE_DEADLINE = 0.5
+MIN_HEDGE_SAMPLES = 20
+LATENCY_SAMPLE_SIZE = 200
+
+_replica_latency = {}  # replica id -> EWMA latency in seconds
+_last_measured = {}  # replica id -> time of the last latency sample
+_recent_latencies = deque(maxlen=LATENCY_SAMPLE_SIZE)
 
 
 def log_client_operation(operation_type, content):
     """Log client operations for the web UI"""
-    log_dir = f"/app/replicas"
+    log_dir = REPLICAS_DIR
     log_file = f"{log_dir}/client_operations.log"
 
     log_entry = {
@@ -21,9 +41,49 @@ def log_client_operation(operation_type, content):
         f.write(json.dumps(log_entry) + "\n")
 
 
-def read_last_line():
+def _expected_latency(replica_id):
+    """EWMA latency of a replica, or 0 if unknown or not measured recently"""
+    if time.time() - _last_measured.get(replica_id, 0) > EWMA_RESET_AFTER:
+        # Forget stale estimates so a replica that was slow once gets retried
+        _replica_latency.pop(replica_id, None)
+    return _replica_latency.get(replica_id, 0.0)
+
+
+def _record_latency(replica_id, latency, sample=True):
+    """Fold a latency into the replica's EWMA (and the hedging samples)"""
+    previous = _replica_latency.get(replica_id)
+    if previous is None:
+        _replica_latency[replica_id] = latency
+    else:
+        _replica_latency[replica_id] = (
+            EWMA_ALPHA * latency + (1 - EWMA_ALPHA) * previous
+        )
+    _last_measured[replica_id] = time.time()
+    if sample:
+        _recent_latencies.append(latency)
+
+
+def _hedge_deadline():
+    """Delay before a hedged request is sent to the next replica"""
+    if len(_recent_latencies) < MIN_HEDGE_SAMPLES:
+        return DEFAULT_HEDGE_DEADLINE
+    latencies = sorted(_recent_latencies)
+    index = min(len(latencies) - 1, int(HEDGE_PERCENTILE * len(latencies)))
+    return latencies[index]
+
+
+def get_replica_latencies():
+    """Return the current EWMA read latency of each replica"""
+    return {
+        f"replica{replica_id}": ewma for replica_id, ewma in _replica_latency.items()
+    }
+
+
+def read_last_line(
+    max_lag_writes=None, max_lag_seconds=None, keyspace=DEFAULT_KEYSPACE
+):
     # Connect to RabbitMQ
-    connection = pika.BlockingConnection(pika.ConnectionParameters("rabbitmq"))
+    connection = pika.BlockingConnection(pika.ConnectionParameters(RABBITMQ_HOST))
     channel = connection.channel()
 
     # Create callback queue
@@ -35,40 +95,74 @@ def read_last_line():
 
     # Set up consumer for response
     responses = []
+    sent_at = {}  # replica name -> time the request was sent
 
     def on_response(ch, method, props, body):
         if props.correlation_id == correlation_id:
             response = body.decode()
             responses.append((props.reply_to, response))
+            replica_id = props.reply_to.replace("replica", "")
+            if props.reply_to in sent_at:
+                _record_latency(replica_id, time.time() - sent_at[props.reply_to])
             print(f"Received from {props.reply_to}: {response}")
 
     channel.basic_consume(
         queue=callback_queue, on_message_callback=on_response, auto_ack=True
     )
 
-    log_client_operation("READ_LAST", "Request sent to all replicas")
+    timeout = 3.0  # seconds
+    start_time = time.time()
 
-    # Send request to all replicas via a direct communication to each
-    for replica_id in range(1, 4):
+    def send_request(replica_id):
+        # The request expires when this read gives up waiting for it
         channel.basic_publish(
             exchange="",
-            routing_key=f"replica{replica_id}",
-            properties=pika.BasicProperties(
-                reply_to=callback_queue,
-                correlation_id=correlation_id,
+            routing_key=read_queue(replica_id, keyspace),
+            properties=request_properties(
+                callback_queue, correlation_id, start_time + timeout - time.time()
             ),
             body="Read Last",
         )
+        sent_at[f"replica{replica_id}"] = time.time()
+        print(f" [x] Sent 'Read Last' request to replica{replica_id}")
+
+    # Skip replicas lagging behind the writers by more than the thresholds,
+    # then try the remaining ones from the fastest to the slowest
+    candidates = sorted(
+        replicas_within_lag(max_lag_writes, max_lag_seconds, keyspace=keyspace),
+        key=lambda replica_id: _expected_latency(str(replica_id)),
+    )
+    hedge_deadline = _hedge_deadline()
 
-    print(" [x] Sent 'Read Last' request to all replicas")
+    log_client_operation(
+        "READ_LAST",
+        f"Request sent to replica{candidates[0]} "
+        f"(hedging after {hedge_deadline * 1000:.0f} ms)",
+    )
 
-    # Wait for the first response or a timeout
-    timeout = 3.0  # seconds
-    start_time = time.time()
+    # Send a single request to the replica expected to answer first
+    send_request(candidates.pop(0))
+
+    # Wait for the first response or a timeout, hedging to the next replica
+    # whenever the current one misses the deadline
+    next_hedge_at = time.time() + hedge_deadline
 
     while time.time() - start_time < timeout and not responses:
-        connection.process_data_events()
-        time.sleep(0.1)
+        connection.process_data_events(time_limit=0.01)
+        if not responses and candidates and time.time() >= next_hedge_at:
+            hedged_replica = candidates.pop(0)
+            log_client_operation("HEDGE", f"Hedged request to replica{hedged_replica}")
+            send_request(hedged_replica)
+            next_hedge_at = time.time() + hedge_deadline
+
+    # Replicas that missed the deadline are at least as slow as the time
+    # they have been waiting, so penalise them accordingly
+    now = time.time()
+    answered = {replica for replica, _ in responses}
+    for replica, sent in sent_at.items():
+        replica_id = replica.replace("replica", "")
+        if replica not in answered and now - sent > _expected_latency(replica_id):
+            _record_latency(replica_id, now - sent, sample=False)
 
     result = {"first_response": None, "all_responses": []}
 
@@ -82,15 +176,8 @@ def read_last_line():
         print("\nNo responses received within the timeout.")
         log_client_operation("TIMEOUT", "No responses received")
 
-    # Wait a bit longer to see if other replicas respond
-    time.sleep(1)
-    connection.process_data_events()
-
-    if len(responses) > 1:
-        print("\nAll received responses:")
-        for replica_id, content in responses:
-            print(f"{replica_id}: {content}")
-            result["all_responses"].append({"replica": replica_id, "content": content})
+    for replica_id, content in responses:
+        result["all_responses"].append({"replica": replica_id, "content": content})
 
     connection.close()
     return result
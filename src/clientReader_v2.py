@@ -2,13 +2,20 @@ import pika
 import uuid
 import time
 import json
+import threading
 from collections import defaultdict
 from datetime import datetime
+from replication_lag import replicas_within_lag
+from keyspaces import DEFAULT_KEYSPACE, bulk_queue, write_queue
+from deadlines import request_properties
+from replica_store import parse_record
+from versions import VERSION_HEADER, newer, observe_version
+from settings import RABBITMQ_HOST, REPLICAS_DIR
 
 
 def log_client_operation(operation_type, content):
     """Log client operations for the web UI"""
-    log_dir = f"/app/replicas"
+    log_dir = REPLICAS_DIR
     log_file = f"{log_dir}/client_operations.log"
 
     log_entry = {
@@ -22,9 +29,45 @@ def log_client_operation(operation_type, content):
         f.write(json.dumps(log_entry) + "\n")
 
 
-def read_all_lines():
+def repair_replicas(repairs, keyspace=DEFAULT_KEYSPACE):
+    """Push the winning version of lines to the replicas missing it.
+
+    `repairs` maps replica ids to lists of (line number, version, content).
+    Each line is sent straight to the replica's write queue with its version,
+    so the replica applies it only if it has nothing newer by then.
+    """
+    connection = pika.BlockingConnection(pika.ConnectionParameters(RABBITMQ_HOST))
+    channel = connection.channel()
+
+    for replica_id, lines in repairs.items():
+        for line_number, version, content in lines:
+            channel.basic_publish(
+                exchange="",
+                routing_key=write_queue(replica_id, keyspace),
+                properties=pika.BasicProperties(headers={VERSION_HEADER: version}),
+                body=f"{line_number} {content}",
+            )
+        print(f" [x] Repaired {len(lines)} line(s) on replica{replica_id}")
+
+    connection.close()
+    log_client_operation(
+        "READ_REPAIR",
+        json.dumps({f"replica{r}": len(lines) for r, lines in repairs.items()}),
+    )
+
+
+def _repair_in_background(repairs, keyspace):
+    try:
+        repair_replicas(repairs, keyspace)
+    except Exception as e:
+        print(f"Read repair failed: {e}")
+
+
+def read_all_lines(
+    max_lag_writes=None, max_lag_seconds=None, keyspace=DEFAULT_KEYSPACE
+):
     # Connect to RabbitMQ
-    connection = pika.BlockingConnection(pika.ConnectionParameters("rabbitmq"))
+    connection = pika.BlockingConnection(pika.ConnectionParameters(RABBITMQ_HOST))
     channel = connection.channel()
 
     # Create callback queue
@@ -37,7 +80,11 @@ def read_all_lines():
     # Store responses from each replica
     replica_data = {"replica1": [], "replica2": [], "replica3": []}
 
-    replica_completed = {"replica1": False, "replica2": False, "replica3": False}
+    # Skip replicas lagging behind the writers by more than the thresholds
+    replica_ids = replicas_within_lag(
+        max_lag_writes, max_lag_seconds, keyspace=keyspace
+    )
+    replica_completed = {f"replica{replica_id}": False for replica_id in replica_ids}
 
     def on_response(ch, method, props, body):
         if props.correlation_id == correlation_id:
@@ -57,28 +104,72 @@ def read_all_lines():
 
     log_client_operation("READ_ALL", "Requesting all data with majority consensus")
 
-    # Send request to all replicas
-    for replica_id in range(1, 4):
+    timeout = 5.0  # seconds
+
+    # Send request to the bulk read lane of the selected replicas; it expires
+    # when this read gives up waiting
+    for replica_id in replica_ids:
         channel.basic_publish(
             exchange="",
-            routing_key=f"replica{replica_id}",
-            properties=pika.BasicProperties(
-                reply_to=callback_queue,
-                correlation_id=correlation_id,
-            ),
+            routing_key=bulk_queue(replica_id, keyspace),
+            properties=request_properties(callback_queue, correlation_id, timeout),
             body="Read All",
         )
 
-    print(" [x] Sent 'Read All' request to all replicas")
+    print(f" [x] Sent 'Read All' request to replicas {replica_ids}")
 
     # Wait for responses with timeout
-    timeout = 5.0  # seconds
     start_time = time.time()
 
     while time.time() - start_time < timeout and not all(replica_completed.values()):
         connection.process_data_events()
         time.sleep(0.1)
 
+    # Each replica sends its lines as versioned records
+    replica_versions = {replica: {} for replica in replica_data}
+    for replica, records in replica_data.items():
+        for record in records:
+            parsed = parse_record(record)
+            if parsed is not None:
+                line_number, version, content = parsed
+                replica_versions[replica][line_number] = (version, content)
+        replica_data[replica] = [
+            f"{line_number} {content}"
+            for line_number, (_, content) in replica_versions[replica].items()
+        ]
+
+    # The highest version of each line wins
+    winners = {}
+    for versions in replica_versions.values():
+        for line_number, (version, content) in versions.items():
+            if line_number not in winners or newer(
+                version, content, *winners[line_number]
+            ):
+                winners[line_number] = (version, content)
+    if winners:
+        # Writes made after this read must win over what it has seen
+        observe_version(max(version for version, _ in winners.values()))
+
+    # Replicas that sent their whole content but miss a winning version are
+    # repaired in the background, so the read does not wait for it
+    repairs = {}
+    for replica, completed in replica_completed.items():
+        if not completed:
+            continue
+        versions = replica_versions[replica]
+        stale = [
+            (line_number, version, content)
+            for line_number, (version, content) in sorted(winners.items())
+            if line_number not in versions
+            or newer(version, content, *versions[line_number])
+        ]
+        if stale:
+            repairs[int(replica[len("replica") :])] = stale
+    if repairs:
+        threading.Thread(
+            target=_repair_in_background, args=(repairs, keyspace), daemon=True
+        ).start()
+
     # Now determine the majority content for each line
     all_lines = set()
     for lines in replica_data.values():
@@ -91,11 +182,12 @@ def read_all_lines():
         for line in lines:
             line_counts[line] += 1
 
-    # Get majority consensus
+    # Get majority consensus among the replicas that were queried
+    quorum = len(replica_ids) // 2 + 1
     majority_lines = []
     print("\n=== MAJORITY CONSENSUS DATA ===")
     for line, count in sorted(line_counts.items()):
-        if count >= 2:  # At least 2 replicas agree (majority of 3)
+        if count >= quorum:  # A majority of the queried replicas agree
             majority_lines.append((line, count))
             print(f"{line} (appeared in {count} replicas)")
 
@@ -108,9 +200,16 @@ def read_all_lines():
         for line in sorted(lines):
             print(f"  {line}")
 
+    repaired = {f"replica{r}": len(lines) for r, lines in repairs.items()}
     log_client_operation(
         "CONSENSUS_RESULT",
-        json.dumps({"majority_lines": majority_lines, "raw_data": raw_data}),
+        json.dumps(
+            {
+                "majority_lines": majority_lines,
+                "raw_data": raw_data,
+                "repairs": repaired,
+            }
+        ),
     )
 
-    return {"majority_lines": majority_lines, "raw_data": raw_data}
+    return {"majority_lines": majority_lines, "raw_data": raw_data, "repairs": repaired}
@@ -0,0 +1,107 @@
+import pika
+import uuid
+import json
+import threading
+from collections import deque
+from datetime import datetime
+from change_feed import CHANGE_FEED_EXCHANGE, change_routing_key
+from keyspaces import DEFAULT_KEYSPACE, bulk_queue
+from settings import RABBITMQ_HOST, REPLICAS_DIR
+
+# Number of recent (replica, watermark) pairs remembered to drop events that
+# arrive both from the replay and from the live feed
+DEDUP_WINDOW = 10000
+
+
+def log_client_operation(operation_type, content):
+    """Log client operations for the web UI"""
+    log_dir = REPLICAS_DIR
+    log_file = f"{log_dir}/client_operations.log"
+
+    log_entry = {
+        "timestamp": datetime.now().isoformat(),
+        "operation": operation_type,
+        "content": content,
+        "client": "client_subscriber",
+    }
+
+    with open(log_file, "a") as f:
+        f.write(json.dumps(log_entry) + "\n")
+
+
+def subscribe_changes(
+    on_change,
+    keyspace=DEFAULT_KEYSPACE,
+    since_watermark=None,
+    replica_ids=range(1, 4),
+    stop_event=None,
+):
+    """Stream the writes applied by the replicas to `on_change(event)`.
+
+    Each event is a dict with `replica`, `keyspace`, `line`, `content`,
+    `watermark` and `timestamp`. When `since_watermark` is given, every
+    replica first replays the events newer than it, so a subscriber can
+    resume where it left off; live events are buffered meanwhile. Blocks
+    until `stop_event` is set.
+    """
+    stop_event = stop_event or threading.Event()
+    replica_ids = list(replica_ids)
+
+    # Connect to RabbitMQ
+    connection = pika.BlockingConnection(pika.ConnectionParameters(RABBITMQ_HOST))
+    channel = connection.channel()
+    channel.exchange_declare(exchange=CHANGE_FEED_EXCHANGE, exchange_type="topic")
+
+    # Bind a private queue to the change events of the selected replicas
+    result = channel.queue_declare(queue="", exclusive=True)
+    feed_queue = result.method.queue
+    for replica_id in replica_ids:
+        channel.queue_bind(
+            exchange=CHANGE_FEED_EXCHANGE,
+            queue=feed_queue,
+            routing_key=change_routing_key(keyspace, replica_id),
+        )
+
+    seen = set()
+    seen_order = deque()
+
+    def on_event(ch, method, props, body):
+        event = json.loads(body)
+        key = (event["replica"], event["watermark"])
+        if event["watermark"] is not None:
+            if key in seen:
+                return
+            seen.add(key)
+            seen_order.append(key)
+            if len(seen_order) > DEDUP_WINDOW:
+                seen.discard(seen_order.popleft())
+        on_change(event)
+
+    channel.basic_consume(queue=feed_queue, on_message_callback=on_event, auto_ack=True)
+
+    # Ask each replica's bulk read lane to replay what happened after the
+    # watermark; the replies land in the same queue as the live events
+    if since_watermark is not None:
+        correlation_id = str(uuid.uuid4())
+        for replica_id in replica_ids:
+            channel.basic_publish(
+                exchange="",
+                routing_key=bulk_queue(replica_id, keyspace),
+                properties=pika.BasicProperties(
+                    reply_to=feed_queue, correlation_id=correlation_id
+                ),
+                body=f"Changes Since {since_watermark}",
+            )
+
+    log_client_operation(
+        "SUBSCRIBE",
+        f"Change feed of {keyspace} from watermark {since_watermark or 'now'}",
+    )
+    print(f" [*] Subscribed to the change feed of {keyspace}")
+
+    try:
+        while not stop_event.is_set():
+            connection.process_data_events(time_limit=1)
+    finally:
+        if connection.is_open:
+            connection.close()
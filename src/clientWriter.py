@@ -1,12 +1,58 @@
 import pika
 import time
 import json
+import threading
+import functools
+from collections import deque
 from datetime import datetime
+from replication_lag import WATERMARK_HEADER, next_watermark
+from keyspaces import DEFAULT_KEYSPACE, write_exchange_type, write_queue, write_target
+from write_ids import WRITE_ID_HEADER, new_write_id
+from versions import VERSION_HEADER, next_version
+from settings import RABBITMQ_HOST, REPLICAS_DIR
 
+# Maximum number of published messages awaiting a broker confirm
+DEFAULT_INFLIGHT_WINDOW = 256
+# Replica queue depth above which the writer applies backpressure
+DEFAULT_MAX_QUEUE_DEPTH = 10000
+# How often (seconds) the writer polls the replica queue depths
+QUEUE_DEPTH_POLL_INTERVAL = 0.5
+# Seconds between two checks for a failed connection while the window is full
+WINDOW_POLL_INTERVAL = 0.5
+# Number of confirm latencies kept for the stats percentiles
+LATENCY_SAMPLE_SIZE = 1000
+# How many times a failed or nacked write is retried before giving up
+DEFAULT_WRITE_RETRIES = 3
+# Delay (seconds) before the first retry of send_message, doubled each time
+WRITE_RETRY_BACKOFF = 0.1
 
-def log_client_operation(operation_type, content):
+
+class BackpressureError(Exception):
+    """Raised when the replica queues stay above the depth limit"""
+
+
+class PublishNackedError(Exception):
+    """Raised when the broker refused one or more published messages"""
+
+
+class PublishFailedError(Exception):
+    """Raised when the connection failed before every write was confirmed.
+
+    `unconfirmed` lists the (message, headers) pairs of the writes that may
+    not have reached the replicas. Publishing them again with the write id,
+    version and watermark of their headers is idempotent.
+    """
+
+    def __init__(self, message, unconfirmed):
+        super().__init__(message)
+        self.unconfirmed = unconfirmed
+
+
+def log_client_operation(
+    operation_type, content, watermark=None, keyspace=DEFAULT_KEYSPACE
+):
     """Log client operations for the web UI"""
-    log_dir = f"/app/replicas"
+    log_dir = REPLICAS_DIR
     log_file = f"{log_dir}/client_operations.log"
 
     log_entry = {
@@ -15,25 +61,459 @@ def log_client_operation(operation_type, content):
         "content": content,
         "client": "client_writer",
     }
+    if watermark is not None:
+        log_entry["watermark"] = watermark
+    if keyspace != DEFAULT_KEYSPACE:
+        log_entry["keyspace"] = keyspace
 
     with open(log_file, "a") as f:
         f.write(json.dumps(log_entry) + "\n")
 
 
-def send_message(message):
-    # Connect to RabbitMQ
-    connection = pika.BlockingConnection(pika.ConnectionParameters("rabbitmq"))
-    channel = connection.channel()
+def send_message(
+    message, keyspace=DEFAULT_KEYSPACE, write_id=None, retries=DEFAULT_WRITE_RETRIES
+):
+    """Publish a write, retrying until the broker confirms it.
+
+    Every attempt carries the same write id, so replicas that already got an
+    earlier attempt skip the retry. Returns the write id.
+    """
+    exchange, routing_key = write_target(keyspace)
+
+    # Stamp the write with a watermark so replicas can report their lag, an
+    # id so they can recognise retries and the version of the line it writes
+    watermark = next_watermark()
+    write_id = write_id or new_write_id()
+    properties = pika.BasicProperties(
+        headers={
+            WATERMARK_HEADER: watermark,
+            WRITE_ID_HEADER: write_id,
+            VERSION_HEADER: next_version(),
+        }
+    )
+
+    for attempt in range(retries + 1):
+        connection = None
+        try:
+            # Connect to RabbitMQ
+            connection = pika.BlockingConnection(
+                pika.ConnectionParameters(RABBITMQ_HOST)
+            )
+            channel = connection.channel()
+
+            # Declare exchange for broadcasting to all replicas serving the keyspace
+            channel.exchange_declare(
+                exchange=exchange, exchange_type=write_exchange_type(keyspace)
+            )
+
+            # Publish message to exchange and wait for the broker to confirm
+            # it; a write no replica queue is bound for raises UnroutableError
+            channel.confirm_delivery()
+            channel.basic_publish(
+                exchange=exchange,
+                routing_key=routing_key,
+                properties=properties,
+                body=message,
+                mandatory=True,
+            )
+            break
+        except pika.exceptions.UnroutableError:
+            # Retrying cannot help until a replica serves the keyspace
+            raise
+        except pika.exceptions.AMQPError as e:
+            if attempt == retries:
+                raise
+            delay = WRITE_RETRY_BACKOFF * 2**attempt
+            print(f"Write attempt {attempt + 1} failed ({e!r}), retrying in {delay}s")
+            time.sleep(delay)
+        finally:
+            if connection is not None and connection.is_open:
+                connection.close()
+
+    print(f" [x] Sent to {keyspace}: {message}")
+    log_client_operation("WRITE", message, watermark, keyspace)
+    return write_id
+
+
+class PipelinedWriter:
+    """Keep a single connection open and pipeline writes with publisher confirms.
+
+    All writes go to the given keyspace.
+
+    Up to `window` messages may be awaiting a broker confirm at any time; once
+    the window is full `publish` blocks until confirms come back. The depth of
+    every replica queue is polled in the background and, when one of them
+    exceeds `max_queue_depth`, `publish` either blocks until it drains
+    (`on_backpressure="block"`) or raises `BackpressureError` (`"raise"`).
+
+    A nacked message is republished with its original write id up to
+    `retries` times, so replicas ignore the copies they already received.
+    Messages are published as mandatory, so a write that no replica queue
+    receives is returned by the broker and reported as nacked.
+    If the connection fails, the writes left unconfirmed are reported by
+    `PublishFailedError` and can be retried the same way on a new writer.
+    """
+
+    def __init__(
+        self,
+        window=DEFAULT_INFLIGHT_WINDOW,
+        max_queue_depth=DEFAULT_MAX_QUEUE_DEPTH,
+        on_backpressure="block",
+        backpressure_timeout=30.0,
+        connect_timeout=10.0,
+        keyspace=DEFAULT_KEYSPACE,
+        retries=DEFAULT_WRITE_RETRIES,
+    ):
+        if on_backpressure not in ("block", "raise"):
+            raise ValueError("on_backpressure must be 'block' or 'raise'")
+
+        self.keyspace = keyspace
+        self._exchange, self._routing_key = write_target(keyspace)
+        self.max_queue_depth = max_queue_depth
+        self.on_backpressure = on_backpressure
+        self.backpressure_timeout = backpressure_timeout
+        self.retries = retries
+
+        self._window = threading.BoundedSemaphore(window)
+        self._condition = threading.Condition()
+        self._ready = threading.Event()
+        self._closing = False
+        self._error = None
+
+        # Only touched from the I/O loop thread
+        self._channel = None
+        self._probe_channel = None
+        self._next_delivery_tag = 0
+        # delivery tag -> (publish time, message, headers, attempt)
+        self._pending = {}
+        # Ids of the writes the broker returned as unroutable
+        self._returned = set()
+
+        # Shared with the caller thread, guarded by self._condition
+        self._queue_depths = {}
+        self._nacked = []
+        self._nack_count = 0
+        self._retried = 0
+        self._published = 0
+        self._confirmed = 0
+        # write id -> (message, headers), for writes neither confirmed nor
+        # given up on
+        self._unconfirmed = {}
+        self._latencies = deque(maxlen=LATENCY_SAMPLE_SIZE)
+        self._started_at = time.time()
+
+        self._connection = pika.SelectConnection(
+            pika.ConnectionParameters(RABBITMQ_HOST),
+            on_open_callback=self._on_connection_open,
+            on_open_error_callback=self._on_connection_error,
+            on_close_callback=self._on_connection_closed,
+        )
+        self._thread = threading.Thread(
+            target=self._connection.ioloop.start, daemon=True
+        )
+        self._thread.start()
+
+        if not self._ready.wait(connect_timeout) or self._error:
+            self._connection.ioloop.add_callback_threadsafe(
+                self._connection.ioloop.stop
+            )
+            raise Exception(f"Failed to open pipelined writer: {self._error}")
+
+    # ---- I/O loop callbacks ----
+
+    def _on_connection_open(self, connection):
+        connection.channel(on_open_callback=self._on_channel_open)
+        connection.channel(on_open_callback=self._on_probe_channel_open)
+
+    def _on_connection_error(self, connection, error):
+        self._error = error
+        self._ready.set()
+        connection.ioloop.stop()
+
+    def _on_connection_closed(self, connection, reason):
+        if not self._closing:
+            self._error = reason
+            print(f"Pipelined writer connection closed: {reason}")
+        with self._condition:
+            self._condition.notify_all()
+        self._ready.set()
+        connection.ioloop.stop()
+
+    def _on_channel_open(self, channel):
+        self._channel = channel
+        channel.add_on_return_callback(self._on_return)
+        channel.exchange_declare(
+            exchange=self._exchange,
+            exchange_type=write_exchange_type(self.keyspace),
+            callback=lambda frame: channel.confirm_delivery(
+                self._on_delivery_confirmation,
+                callback=lambda frame: self._ready.set(),
+            ),
+        )
+
+    def _on_probe_channel_open(self, channel):
+        self._probe_channel = channel
+        # A passive declare on a missing queue closes the channel, so reopen it
+        channel.add_on_close_callback(self._on_probe_channel_closed)
+        self._poll_queue_depths()
+
+    def _on_probe_channel_closed(self, channel, reason):
+        self._probe_channel = None
+        if not self._closing and self._connection.is_open:
+            self._connection.ioloop.call_later(
+                QUEUE_DEPTH_POLL_INTERVAL,
+                lambda: self._connection.channel(
+                    on_open_callback=self._on_probe_channel_open
+                ),
+            )
+
+    def _poll_queue_depths(self):
+        channel = self._probe_channel
+        if self._closing or channel is None or not channel.is_open:
+            return
+
+        for replica_id in range(1, 4):
+            queue = write_queue(replica_id, self.keyspace)
+            channel.queue_declare(
+                queue=queue,
+                passive=True,
+                callback=functools.partial(self._on_queue_depth, queue),
+            )
+
+        self._connection.ioloop.call_later(
+            QUEUE_DEPTH_POLL_INTERVAL, self._poll_queue_depths
+        )
+
+    def _on_queue_depth(self, queue, method_frame):
+        with self._condition:
+            self._queue_depths[queue] = method_frame.method.message_count
+            self._condition.notify_all()
+
+    def _publish(self, message, headers, attempt=0):
+        self._next_delivery_tag += 1
+        self._pending[self._next_delivery_tag] = (
+            time.time(),
+            message,
+            headers,
+            attempt,
+        )
+        self._channel.basic_publish(
+            exchange=self._exchange,
+            routing_key=self._routing_key,
+            properties=pika.BasicProperties(headers=headers),
+            body=message,
+            mandatory=True,
+        )
+
+    def _on_return(self, channel, method, properties, body):
+        # The broker confirms a returned message right after returning it
+        print(f"Pipelined write unroutable ({method.reply_text}): {body!r}")
+        self._returned.add((properties.headers or {}).get(WRITE_ID_HEADER))
+
+    def _on_delivery_confirmation(self, method_frame):
+        method = method_frame.method
+        acked = method.NAME == "Basic.Ack"
+
+        if method.multiple:
+            tags = [tag for tag in self._pending if tag <= method.delivery_tag]
+        else:
+            tags = [method.delivery_tag]
+
+        now = time.time()
+        retries = []
+        with self._condition:
+            for tag in tags:
+                entry = self._pending.pop(tag, None)
+                if entry is None:
+                    continue
+                sent_at, message, headers, attempt = entry
+                unroutable = headers[WRITE_ID_HEADER] in self._returned
+                self._returned.discard(headers[WRITE_ID_HEADER])
+                if unroutable:
+                    # No replica serves the keyspace, so a retry cannot help
+                    self._nack_count += 1
+                    self._nacked.append(message)
+                elif acked:
+                    self._confirmed += 1
+                    self._latencies.append(now - sent_at)
+                elif attempt < self.retries:
+                    # Keeps its window slot until the retry is confirmed
+                    self._retried += 1
+                    retries.append((message, headers, attempt + 1))
+                    continue
+                else:
+                    self._nack_count += 1
+                    self._nacked.append(message)
+                self._unconfirmed.pop(headers[WRITE_ID_HEADER], None)
+                self._window.release()
+            self._condition.notify_all()
+
+        for message, headers, attempt in retries:
+            self._publish(message, headers, attempt)
+
+    # ---- Caller API ----
+
+    def _overloaded_queues(self):
+        return {
+            queue: depth
+            for queue, depth in self._queue_depths.items()
+            if depth > self.max_queue_depth
+        }
+
+    def _wait_for_queue_capacity(self):
+        with self._condition:
+            overloaded = self._overloaded_queues()
+            if not overloaded:
+                return
+            if self.on_backpressure == "raise":
+                raise BackpressureError(f"Replica queues over limit: {overloaded}")
+
+            deadline = time.time() + self.backpressure_timeout
+            while overloaded and self._error is None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise BackpressureError(
+                        f"Replica queues did not drain within "
+                        f"{self.backpressure_timeout}s: {overloaded}"
+                    )
+                self._condition.wait(remaining)
+                overloaded = self._overloaded_queues()
+
+    def _failed(self):
+        with self._condition:
+            unconfirmed = list(self._unconfirmed.values())
+        return PublishFailedError(
+            f"Pipelined writer failed with {len(unconfirmed)} unconfirmed "
+            f"message(s): {self._error}",
+            unconfirmed,
+        )
+
+    def publish(self, message, write_id=None, version=None, watermark=None):
+        """Publish a write without waiting for its confirm, returning its id.
+
+        A retry of an unconfirmed write passes the write id, version and
+        watermark it was first published with, so replicas that already
+        applied it skip it and it never overwrites a later write to its line.
+        """
+        if self._error is not None:
+            raise self._failed()
+
+        self._wait_for_queue_capacity()
+        # Wake up now and then so a dropped connection fails the caller
+        # instead of leaving it waiting for confirms that never come
+        while not self._window.acquire(timeout=WINDOW_POLL_INTERVAL):
+            if self._error is not None:
+                raise self._failed()
+
+        # A retried write was logged when it was first published
+        retry = watermark is not None
+        watermark = watermark if retry else next_watermark()
+        write_id = write_id or new_write_id()
+        headers = {
+            WATERMARK_HEADER: watermark,
+            WRITE_ID_HEADER: write_id,
+            VERSION_HEADER: next_version() if version is None else version,
+        }
+        with self._condition:
+            self._published += 1
+            self._unconfirmed[write_id] = (message, headers)
+        self._connection.ioloop.add_callback_threadsafe(
+            functools.partial(self._publish, message, headers)
+        )
+        if not retry:
+            log_client_operation("WRITE", message, watermark, self.keyspace)
+        return write_id
+
+    def flush(self, timeout=None):
+        """Wait until every published message is confirmed or nacked.
+
+        Raises `PublishFailedError` if the connection failed first, since the
+        writes still in flight may be lost.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._condition:
+            while (
+                self._confirmed + self._nack_count < self._published
+                and self._error is None
+            ):
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    raise TimeoutError("Timed out waiting for publisher confirms")
+                self._condition.wait(remaining)
+
+            failed = self._confirmed + self._nack_count < self._published
+            nacked, self._nacked = self._nacked, []
+
+        if failed:
+            raise self._failed()
+
+        if nacked:
+            raise PublishNackedError(f"{len(nacked)} message(s) nacked: {nacked}")
+
+    def stats(self):
+        """Return throughput and confirm latency statistics"""
+        with self._condition:
+            latencies = sorted(self._latencies)
+            elapsed = max(time.time() - self._started_at, 1e-9)
+
+            def percentile(p):
+                if not latencies:
+                    return None
+                return latencies[min(len(latencies) - 1, int(p * len(latencies)))]
+
+            return {
+                "published": self._published,
+                "confirmed": self._confirmed,
+                "nacked": self._nack_count,
+                "retried": self._retried,
+                "in_flight": self._published - self._confirmed - self._nack_count,
+                "throughput_msgs_per_s": self._confirmed / elapsed,
+                "confirm_latency_avg_s": (
+                    sum(latencies) / len(latencies) if latencies else None
+                ),
+                "confirm_latency_p50_s": percentile(0.50),
+                "confirm_latency_p99_s": percentile(0.99),
+                "queue_depths": dict(self._queue_depths),
+            }
+
+    def close(self, timeout=None):
+        """Flush outstanding confirms and close the connection"""
+        try:
+            self.flush(timeout)
+        finally:
+            self._shutdown(timeout)
+
+    def _shutdown(self, timeout=None):
+        self._closing = True
+        if self._connection.is_open:
+            self._connection.ioloop.add_callback_threadsafe(self._connection.close)
+        self._thread.join(timeout)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            # Keep the caller's exception rather than flushing again
+            self._shutdown()
 
-    # Declare exchange for broadcasting to all replicas
-    channel.exchange_declare(exchange="replication_exchange", exchange_type="fanout")
 
-    # Publish message to exchange
-    channel.basic_publish(exchange="replication_exchange", routing_key="", body=message)
+def send_messages(messages, window=DEFAULT_INFLIGHT_WINDOW, **kwargs):
+    """Send a burst of messages over one pipelined, confirmed connection"""
+    with PipelinedWriter(window=window, **kwargs) as writer:
+        for message in messages:
+            writer.publish(message)
+        writer.flush()
+        stats = writer.stats()
 
-    print(f" [x] Sent: {message}")
-    log_client_operation("WRITE", message)
-    connection.close()
+    print(
+        f" [x] Sent {stats['confirmed']} messages "
+        f"({stats['throughput_msgs_per_s']:.0f} msg/s, "
+        f"p99 confirm {stats['confirm_latency_p99_s']}s)"
+    )
+    return stats
 
 
 def connect_with_retry(max_retries=10, retry_interval=2):
@@ -41,7 +521,7 @@ def connect_with_retry(max_retries=10, retry_interval=2):
     retries = 0
     while retries < max_retries:
         try:
-            return pika.BlockingConnection(pika.ConnectionParameters("rabbitmq"))
+            return pika.BlockingConnection(pika.ConnectionParameters(RABBITMQ_HOST))
         except pika.exceptions.AMQPConnectionError:
             retries += 1
             print(
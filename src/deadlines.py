@@ -0,0 +1,31 @@
+import time
+import pika
+
+# AMQP header carrying the absolute time (UNIX seconds) after which the
+# client no longer waits for the reply to a request
+DEADLINE_HEADER = "deadline"
+
+
+def request_properties(reply_to, correlation_id, timeout):
+    """Properties of a read request the client waits `timeout` seconds for.
+
+    The deadline header lets replicas drop the request once the client has
+    given up, and the message expiration lets RabbitMQ drop it while it is
+    still queued.
+    """
+    return pika.BasicProperties(
+        reply_to=reply_to,
+        correlation_id=correlation_id,
+        headers={DEADLINE_HEADER: time.time() + timeout},
+        expiration=str(int(timeout * 1000)),
+    )
+
+
+def request_deadline(properties):
+    """Deadline of a request, or None if it has none"""
+    headers = properties.headers or {}
+    return headers.get(DEADLINE_HEADER)
+
+
+def is_expired(deadline, now=None):
+    return deadline is not None and (now or time.time()) > deadline
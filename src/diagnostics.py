@@ -0,0 +1,273 @@
+import os
+import gc
+import sys
+import json
+import time
+import pika
+import resource
+import functools
+import threading
+from collections import Counter, deque
+from keyspaces import control_queue
+from deadlines import is_expired, request_deadline
+
+# Seconds between two samples of the profiler
+DEFAULT_PROFILE_INTERVAL = 0.01
+# Shortest interval accepted, so the sampler never spins
+MIN_PROFILE_INTERVAL = 0.001
+# Frames kept per sampled stack, from the innermost one
+MAX_STACK_DEPTH = 64
+# Functions and stacks listed in a profile report
+PROFILE_TOP = 30
+# Durations kept per handler for the timing percentiles
+TIMING_SAMPLE_SIZE = 1000
+
+_timings_lock = threading.Lock()
+_timings = {}  # handler name -> counters
+
+
+def timed(name):
+    """Count the calls and time spent in a hot-path handler"""
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                _record_timing(name, time.perf_counter() - started)
+
+        return wrapper
+
+    return decorator
+
+
+def _record_timing(name, duration):
+    with _timings_lock:
+        timing = _timings.get(name)
+        if timing is None:
+            timing = _timings[name] = {
+                "calls": 0,
+                "total_s": 0.0,
+                "max_s": 0.0,
+                "recent": deque(maxlen=TIMING_SAMPLE_SIZE),
+            }
+        timing["calls"] += 1
+        timing["total_s"] += duration
+        timing["max_s"] = max(timing["max_s"], duration)
+        timing["recent"].append(duration)
+
+
+def handler_timings(reset=False):
+    """Return the timing counters of each instrumented handler"""
+    with _timings_lock:
+        report = {}
+        for name, timing in _timings.items():
+            recent = sorted(timing["recent"])
+
+            def percentile(p):
+                return recent[min(len(recent) - 1, int(p * len(recent)))]
+
+            report[name] = {
+                "calls": timing["calls"],
+                "total_s": timing["total_s"],
+                "avg_s": timing["total_s"] / timing["calls"],
+                "p50_s": percentile(0.50),
+                "p99_s": percentile(0.99),
+                "max_s": timing["max_s"],
+            }
+        if reset:
+            _timings.clear()
+        return report
+
+
+class SamplingProfiler:
+    """Statistical profiler sampling the stacks of every thread.
+
+    A background thread wakes up every `interval` seconds and records the
+    current stack of each other thread, so the cost stays low and bounded
+    whatever the replica is doing. Stacks are reported in the folded format
+    ("thread;outer;...;inner count") understood by flame graph tools.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop_event = threading.Event()
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self, interval=DEFAULT_PROFILE_INTERVAL, ignore_thread=None):
+        with self._lock:
+            if self._thread is not None:
+                return False
+            self.interval = interval
+            self.samples = 0
+            self.stacks = Counter()
+            self.started_at = time.time()
+            self._stop_event.clear()
+            self._thread = threading.Thread(
+                target=self._run, args=(ignore_thread,), name="profiler", daemon=True
+            )
+            self._thread.start()
+            return True
+
+    def _run(self, ignore_thread):
+        ignored = {threading.get_ident(), ignore_thread}
+        while not self._stop_event.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id in ignored:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < MAX_STACK_DEPTH:
+                    code = frame.f_code
+                    stack.append(
+                        f"{code.co_name} ({os.path.basename(code.co_filename)}"
+                        f":{code.co_firstlineno})"
+                    )
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def stop(self):
+        """Stop sampling and return the profile"""
+        with self._lock:
+            if self._thread is None:
+                return None
+            self._stop_event.set()
+            self._thread.join()
+            self._thread = None
+            return self._report(time.time() - self.started_at)
+
+    def _report(self, duration):
+        own, inclusive = Counter(), Counter()
+        for stack, count in self.stacks.items():
+            functions = stack.split(";")[1:]
+            if functions:
+                own[functions[-1]] += count
+            for function in set(functions):
+                inclusive[function] += count
+
+        # Share of the samples of all threads spent in each function
+        total = max(sum(self.stacks.values()), 1)
+        return {
+            "duration_s": duration,
+            "interval_s": self.interval,
+            "samples": self.samples,
+            "top_self": [
+                {"function": function, "samples": count, "share": count / total}
+                for function, count in own.most_common(PROFILE_TOP)
+            ],
+            "top_inclusive": [
+                {"function": function, "samples": count, "share": count / total}
+                for function, count in inclusive.most_common(PROFILE_TOP)
+            ],
+            "folded_stacks": [
+                f"{stack} {count}" for stack, count in self.stacks.most_common()
+            ],
+        }
+
+
+def _current_rss_kb():
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+    return pages * os.sysconf("SC_PAGE_SIZE") // 1024
+
+
+def memory_usage(keyspaces):
+    """Report the memory used by the replica and the size of its indexes"""
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return {
+        "rss_kb": _current_rss_kb(),
+        "max_rss_kb": usage.ru_maxrss,
+        "gc_objects": len(gc.get_objects()),
+        "gc_counts": gc.get_count(),
+        "threads": threading.active_count(),
+        "keyspaces": {
+            keyspace.name: {
+                "tail_index_lines": len(keyspace.store.tail),
+                "data_bytes": keyspace.store.size,
+                "write_ids": len(keyspace.store.write_ids),
+                "pending_writes": len(keyspace.pending_writes),
+            }
+            for keyspace in keyspaces
+        },
+    }
+
+
+def serve_control(replica_id, keyspaces, connection):
+    """Answer diagnostic commands sent to the replica's control queue.
+
+    Commands are JSON objects with a `command` of "profile_start" (optional
+    `interval`), "profile_stop", "timings" (optional `reset`) or "memory".
+    They are served on their own thread and connection, so they still get
+    an answer while the keyspace workers are busy. A request that cannot be
+    answered is rejected on its own and never stops the thread.
+    """
+    channel = connection.channel()
+    queue = control_queue(replica_id)
+    channel.queue_declare(queue=queue, exclusive=False)
+    profiler = SamplingProfiler()
+
+    def respond_to(request):
+        command = request.get("command")
+        if command == "profile_start":
+            interval = float(request.get("interval", DEFAULT_PROFILE_INTERVAL))
+            if not interval >= MIN_PROFILE_INTERVAL:
+                raise ValueError(
+                    f"interval must be at least {MIN_PROFILE_INTERVAL}s, got {interval}"
+                )
+            started = profiler.start(interval, ignore_thread=threading.get_ident())
+            response = {"started": started, "interval_s": interval}
+            if not started:
+                response["error"] = "The profiler is already running"
+            return response
+        if command == "profile_stop":
+            return profiler.stop() or {"error": "The profiler is not running"}
+        if command == "timings":
+            return handler_timings(reset=bool(request.get("reset")))
+        if command == "memory":
+            return memory_usage(keyspaces)
+        return {"error": f"Unknown command {command!r}"}
+
+    def on_request(ch, method, props, body):
+        if not props.reply_to:
+            print(f"Replica {replica_id} dropped control request without reply_to")
+            ch.basic_ack(delivery_tag=method.delivery_tag)
+            return
+
+        try:
+            if is_expired(request_deadline(props)):
+                print(f"Replica {replica_id} dropped expired control request {body}")
+                ch.basic_ack(delivery_tag=method.delivery_tag)
+                return
+            response = json.dumps(respond_to(json.loads(body)))
+        except Exception as e:
+            response = json.dumps({"error": f"Invalid control request: {e}"})
+
+        print(f"Replica {replica_id} answered control request {body}")
+        ch.basic_publish(
+            exchange="",
+            routing_key=props.reply_to,
+            properties=pika.BasicProperties(
+                correlation_id=props.correlation_id, reply_to=f"replica{replica_id}"
+            ),
+            body=response,
+        )
+        ch.basic_ack(delivery_tag=method.delivery_tag)
+
+    channel.basic_consume(queue=queue, on_message_callback=on_request)
+    print(f" [*] Replica {replica_id} serving control requests on {queue}")
+    try:
+        channel.start_consuming()
+    finally:
+        profiler.stop()
+        connection.close()
@@ -0,0 +1,96 @@
+import os
+import re
+from settings import REPLICAS_DIR
+
+# Keyspace served by every replica, stored and routed exactly as before
+# keyspaces existed so existing data and clients keep working
+DEFAULT_KEYSPACE = "default"
+
+# Direct exchange routing writes of named keyspaces by keyspace name
+KEYSPACE_EXCHANGE = "keyspace_exchange"
+
+_KEYSPACE_NAME = re.compile(r"^[A-Za-z0-9_-]+$")
+# Suffixes of a replica's own queues, which a keyspace read queue
+# ("replicaN.<name>") would otherwise collide with
+RESERVED_KEYSPACE_NAMES = {"bulk", "snapshot", "control", "writes"}
+
+
+def validate_keyspace(keyspace):
+    """Reject keyspace names that are unsafe as paths or routing keys"""
+    if not _KEYSPACE_NAME.match(keyspace or ""):
+        raise ValueError(
+            f"Invalid keyspace {keyspace!r}: use letters, digits, '_' or '-'"
+        )
+    if keyspace in RESERVED_KEYSPACE_NAMES:
+        raise ValueError(f"Invalid keyspace {keyspace!r}: the name is reserved")
+    return keyspace
+
+
+def configured_keyspaces():
+    """Keyspaces served by this replica, from the KEYSPACES variable"""
+    names = os.environ.get("KEYSPACES", DEFAULT_KEYSPACE).split(",")
+    keyspaces = [validate_keyspace(name.strip()) for name in names if name.strip()]
+    if DEFAULT_KEYSPACE not in keyspaces:
+        keyspaces.insert(0, DEFAULT_KEYSPACE)
+    return keyspaces
+
+
+def write_target(keyspace=DEFAULT_KEYSPACE):
+    """Return the (exchange, routing key) writes to a keyspace are published to"""
+    if keyspace == DEFAULT_KEYSPACE:
+        return "replication_exchange", ""
+    return KEYSPACE_EXCHANGE, validate_keyspace(keyspace)
+
+
+def write_exchange_type(keyspace=DEFAULT_KEYSPACE):
+    """Type of the exchange returned by `write_target`"""
+    return "fanout" if keyspace == DEFAULT_KEYSPACE else "direct"
+
+
+def write_queue(replica_id, keyspace=DEFAULT_KEYSPACE):
+    """Queue a replica consumes the writes of a keyspace from"""
+    if keyspace == DEFAULT_KEYSPACE:
+        return f"replica{replica_id}_queue"
+    return f"replica{replica_id}.{validate_keyspace(keyspace)}.writes"
+
+
+def read_queue(replica_id, keyspace=DEFAULT_KEYSPACE):
+    """Queue a replica consumes the read requests of a keyspace from"""
+    if keyspace == DEFAULT_KEYSPACE:
+        return f"replica{replica_id}"
+    return f"replica{replica_id}.{validate_keyspace(keyspace)}"
+
+
+def bulk_queue(replica_id, keyspace=DEFAULT_KEYSPACE):
+    """Queue a replica consumes full-scan reads of a keyspace from"""
+    return f"{read_queue(replica_id, keyspace)}.bulk"
+
+
+def snapshot_queue(replica_id, keyspace=DEFAULT_KEYSPACE):
+    """Queue a replica serves snapshot chunks of a keyspace from"""
+    return f"{read_queue(replica_id, keyspace)}.snapshot"
+
+
+def control_queue(replica_id):
+    """Queue a replica answers diagnostic commands on"""
+    return f"replica{replica_id}.control"
+
+
+def declare_write_queue(channel, replica_id, keyspace=DEFAULT_KEYSPACE):
+    """Declare a replica's write queue for a keyspace and bind it for writes"""
+    exchange, routing_key = write_target(keyspace)
+    channel.exchange_declare(
+        exchange=exchange, exchange_type=write_exchange_type(keyspace)
+    )
+    queue_name = write_queue(replica_id, keyspace)
+    channel.queue_declare(queue=queue_name, exclusive=False)
+    channel.queue_bind(exchange=exchange, queue=queue_name, routing_key=routing_key)
+    return queue_name
+
+
+def keyspace_dir(replica_id, keyspace=DEFAULT_KEYSPACE):
+    """Directory holding the data of a keyspace on a replica"""
+    directory = f"{REPLICAS_DIR}/replica{replica_id}"
+    if keyspace == DEFAULT_KEYSPACE:
+        return directory
+    return f"{directory}/keyspaces/{validate_keyspace(keyspace)}"
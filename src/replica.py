@@ -3,183 +3,426 @@ import sys
 import os
 import time
 import json
+import threading
+import functools
 from datetime import datetime
-
-
-def ensure_replica_dir(replica_id):
-    """Ensure the replica directory exists"""
-    directory = f"/app/replicas/replica{replica_id}"
+from replication_lag import (
+    WATERMARK_HEADER,
+    read_applied_watermark,
+    record_applied_watermark,
+)
+from replica_store import ReplicaStore
+from change_feed import (
+    CHANGE_FEED_EXCHANGE,
+    append_changes,
+    change_event,
+    change_routing_key,
+    read_changes_since,
+)
+from keyspaces import (
+    DEFAULT_KEYSPACE,
+    bulk_queue,
+    configured_keyspaces,
+    declare_write_queue,
+    keyspace_dir,
+    read_queue,
+)
+from snapshot import (
+    FENCE_HEADER,
+    bootstrap_keyspace,
+    mark_fence_passed,
+    pending_bootstrap_fence,
+    record_fence,
+    serve_snapshots,
+)
+from write_ids import WRITE_ID_HEADER
+from versions import VERSION_HEADER, valid_version
+from diagnostics import serve_control, timed
+from deadlines import is_expired, request_deadline
+from settings import RABBITMQ_HOST, REPLICAS_DIR
+
+# Durability policy for writes: "always" fsyncs every group commit before the
+# writes are acked, "interval" fsyncs (and acks) every FSYNC_INTERVAL_MS and
+# "os" acks right away and leaves flushing to the operating system
+FSYNC_POLICY = os.environ.get("FSYNC_POLICY", "always")
+# Writes arriving within this window (ms) share a single fsync
+GROUP_COMMIT_WINDOW_MS = float(os.environ.get("GROUP_COMMIT_WINDOW_MS", "2"))
+FSYNC_INTERVAL_MS = float(os.environ.get("FSYNC_INTERVAL_MS", "100"))
+# A group is committed early once it holds this many writes
+GROUP_COMMIT_MAX_BATCH = int(os.environ.get("GROUP_COMMIT_MAX_BATCH", "256"))
+
+# Point reads taken by the read lane at a time
+POINT_READ_PREFETCH = 16
+
+# How many lines a full read sends between two checks of its deadline
+DEADLINE_CHECK_EVERY = 1000
+
+# The index is checkpointed once this many lines were written since the last one
+CHECKPOINT_EVERY = int(os.environ.get("CHECKPOINT_EVERY", "10000"))
+
+
+class Keyspace:
+    """A keyspace served by this replica with its own storage and connection"""
+
+    def __init__(self, replica_id, name):
+        self.name = name
+        self.directory = ensure_replica_dir(replica_id, name)
+
+        # Load the index checkpoint and replay the data written after it
+        start_time = time.time()
+        self.store = ReplicaStore(self.directory)
+        self.startup_ms = (time.time() - start_time) * 1000
+
+        # Writes not yet committed:
+        # (delivery tag, message, watermark, version, applied)
+        self.pending_writes = []
+        self.commit_timer = None
+        self.connection = None
+        self.channel = None
+        self.point_connection = None
+        self.point_channel = None
+        self.bulk_connection = None
+        self.bulk_channel = None
+
+        # After a bootstrap, the buffered writes queued before this fence are
+        # already part of the snapshot and are skipped
+        self.bootstrap_fence = pending_bootstrap_fence(self.directory)
+
+
+def ensure_replica_dir(replica_id, keyspace=DEFAULT_KEYSPACE):
+    """Ensure the replica (or keyspace) directory exists"""
+    directory = keyspace_dir(replica_id, keyspace)
     if not os.path.exists(directory):
         os.makedirs(directory)
     return directory
 
 
-def write_to_file(directory, message):
-    """Write message to the replica's file"""
-    file_path = f"{directory}/data.txt"
-
+@timed("write_to_file")
+def write_to_file(store, message, version=0):
+    """Append message to the replica's file (durable after the next commit)"""
     # Extract line number and content
     parts = message.split(" ", 1)
     if len(parts) != 2:
         print(f"Invalid message format: {message}")
         return False
 
-    line_number = int(parts[0])
+    try:
+        line_number = int(parts[0])
+    except ValueError:
+        print(f"Invalid line number: {message}")
+        return False
     content = parts[1]
 
-    # Read existing lines
-    existing_lines = []
-    if os.path.exists(file_path):
-        with open(file_path, "r") as file:
-            existing_lines = file.readlines()
-
-    # Remove newlines and parse line numbers
-    processed_lines = []
-    line_numbers = []
-    for line in existing_lines:
-        line = line.strip()
-        if line:
-            parts = line.split(" ", 1)
-            if len(parts) == 2:
-                try:
-                    num = int(parts[0])
-                    line_numbers.append(num)
-                    processed_lines.append((num, line))
-                except ValueError:
-                    processed_lines.append((-1, line))  # Invalid format
-
-    # Add new line if it doesn't exist
-    if line_number not in line_numbers:
-        processed_lines.append((line_number, f"{line_number} {content}"))
-
-    # Sort by line number
-    processed_lines.sort(key=lambda x: x[0])
-
-    # Write all lines back to file
-    with open(file_path, "w") as file:
-        for _, line in processed_lines:
-            file.write(f"{line}\n")
-
-    # Also log the operation for the web UI
-    log_operation(replica_id, "WRITE", f"{line_number} {content}")
-
-    print(f"Written to {file_path}: {line_number} {content}")
+    # Last writer wins: skip the write if the line has a newer version
+    if not store.apply(line_number, content, version):
+        print(
+            f"Line {line_number} already has a version >= {version} "
+            f"in {store.file_path}"
+        )
+        return False
+
+    print(f"Written to {store.file_path}: {line_number}@{version} {content}")
     return True
 
 
-def log_operation(replica_id, operation_type, content):
+@timed("commit_pending_writes")
+def commit_pending_writes(keyspace):
+    """Group commit: make the pending writes durable, then ack them"""
+    keyspace.commit_timer = None
+    pending_writes = keyspace.pending_writes
+    if not pending_writes:
+        return
+
+    keyspace.store.commit(fsync=FSYNC_POLICY != "os")
+
+    # Acks are only sent once the writes are on disk
+    keyspace.channel.basic_ack(delivery_tag=pending_writes[-1][0], multiple=True)
+
+    # Also log the operations for the web UI, in one write for the group
+    log_operations(
+        replica_id,
+        [
+            ("WRITE", message, watermark)
+            for _, message, watermark, _, _ in pending_writes
+        ],
+        keyspace.name,
+    )
+
+    # Report the highest watermark applied so far, once for the group
+    watermarks = [write[2] for write in pending_writes if write[2] is not None]
+    if watermarks:
+        record_applied_watermark(replica_id, max(watermarks), keyspace.name)
+
+    events = []
+    for _, message, watermark, version, applied in pending_writes:
+        if applied:
+            line_number, content = message.split(" ", 1)
+            events.append(
+                change_event(
+                    replica_id,
+                    keyspace.name,
+                    int(line_number),
+                    content,
+                    watermark,
+                    version,
+                )
+            )
+
+    # Publish the applied writes on the change feed
+    if events:
+        append_changes(keyspace.directory, events)
+        routing_key = change_routing_key(keyspace.name, replica_id)
+        for event in events:
+            keyspace.channel.basic_publish(
+                exchange=CHANGE_FEED_EXCHANGE,
+                routing_key=routing_key,
+                body=json.dumps(event),
+            )
+
+    print(
+        f"Committed {len(pending_writes)} write(s) to keyspace {keyspace.name} "
+        f"({FSYNC_POLICY} fsync policy)"
+    )
+    pending_writes.clear()
+
+    # Checkpoint the index so a restart only replays the writes made since
+    # (counted in records, since updates append to the data file too)
+    if keyspace.store.tail_records >= CHECKPOINT_EVERY:
+        line_count = keyspace.store.checkpoint()
+        log_operation(
+            replica_id,
+            "CHECKPOINT",
+            f"Index of {line_count} lines",
+            None,
+            keyspace.name,
+        )
+
+
+def schedule_commit(keyspace):
+    """Commit now if the group is full, otherwise when its window closes"""
+    if FSYNC_POLICY == "os" or len(keyspace.pending_writes) >= GROUP_COMMIT_MAX_BATCH:
+        if keyspace.commit_timer is not None:
+            keyspace.connection.remove_timeout(keyspace.commit_timer)
+        commit_pending_writes(keyspace)
+    elif keyspace.commit_timer is None:
+        window_ms = (
+            FSYNC_INTERVAL_MS if FSYNC_POLICY == "interval" else GROUP_COMMIT_WINDOW_MS
+        )
+        keyspace.commit_timer = keyspace.connection.call_later(
+            window_ms / 1000, functools.partial(commit_pending_writes, keyspace)
+        )
+
+
+def log_operation(
+    replica_id, operation_type, content, watermark=None, keyspace=DEFAULT_KEYSPACE
+):
     """Log operations for the web UI"""
-    log_dir = f"/app/replicas/replica{replica_id}"
+    log_operations(replica_id, [(operation_type, content, watermark)], keyspace)
+
+
+def log_operations(replica_id, operations, keyspace=DEFAULT_KEYSPACE):
+    """Log (operation type, content, watermark) entries with a single write"""
+    log_dir = f"{REPLICAS_DIR}/replica{replica_id}"
     if not os.path.exists(log_dir):
         os.makedirs(log_dir)
 
     log_file = f"{log_dir}/operations.log"
 
-    log_entry = {
-        "timestamp": datetime.now().isoformat(),
-        "operation": operation_type,
-        "content": content,
-        "replica": f"replica{replica_id}",
-    }
+    timestamp = datetime.now().isoformat()
+    lines = []
+    for operation_type, content, watermark in operations:
+        log_entry = {
+            "timestamp": timestamp,
+            "operation": operation_type,
+            "content": content,
+            "replica": f"replica{replica_id}",
+        }
+        if watermark is not None:
+            log_entry["watermark"] = watermark
+        if keyspace != DEFAULT_KEYSPACE:
+            log_entry["keyspace"] = keyspace
+        lines.append(json.dumps(log_entry) + "\n")
 
     with open(log_file, "a") as f:
-        f.write(json.dumps(log_entry) + "\n")
-
-
-def handle_read_last_request(replica_id, correlation_id, reply_to):
-    """Handle a request to read the last line of the file"""
-    directory = ensure_replica_dir(replica_id)
-    file_path = f"{directory}/data.txt"
-
-    last_line = ""
-    if os.path.exists(file_path):
-        with open(file_path, "r") as file:
-            lines = file.readlines()
-            if lines:
-                last_line = lines[-1].strip()
-
-    # Log the read operation
-    log_operation(replica_id, "READ_LAST", last_line if last_line else "No data")
+        f.write("".join(lines))
 
-    # Send response back to the client
-    connection = pika.BlockingConnection(pika.ConnectionParameters("rabbitmq"))
-    channel = connection.channel()
 
-    channel.basic_publish(
+def reply(ch, reply_to, correlation_id, body):
+    """Publish a reply to a read request on the lane's own channel"""
+    ch.basic_publish(
         exchange="",
         routing_key=reply_to,
         properties=pika.BasicProperties(
             correlation_id=correlation_id, reply_to=f"replica{replica_id}"
         ),
-        body=last_line,
+        body=body,
     )
-    connection.close()
-    print(f"Replica {replica_id} responded with last line: {last_line}")
 
 
-def handle_read_all_request(replica_id, correlation_id, reply_to):
-    """Handle a request to read all lines of the file"""
-    directory = ensure_replica_dir(replica_id)
-    file_path = f"{directory}/data.txt"
+@timed("handle_read_last_request")
+def handle_read_last_request(ch, keyspace, correlation_id, reply_to):
+    """Handle a request to read the last line of the file"""
+    last_line = keyspace.store.last_line()
 
     # Log the read operation
-    log_operation(replica_id, "READ_ALL", "Full file request")
+    log_operation(
+        replica_id,
+        "READ_LAST",
+        last_line if last_line else "No data",
+        keyspace=keyspace.name,
+    )
+
+    # Send response back to the client
+    reply(ch, reply_to, correlation_id, last_line)
+    print(f"Replica {replica_id} responded with last line: {last_line}")
 
-    # Send each line back to the client
-    connection = pika.BlockingConnection(pika.ConnectionParameters("rabbitmq"))
-    channel = connection.channel()
 
-    if os.path.exists(file_path):
-        with open(file_path, "r") as file:
-            lines = file.readlines()
-
-            for line in lines:
-                line = line.strip()
-                if line:
-                    channel.basic_publish(
-                        exchange="",
-                        routing_key=reply_to,
-                        properties=pika.BasicProperties(
-                            correlation_id=correlation_id,
-                            reply_to=f"replica{replica_id}",
-                        ),
-                        body=line,
-                    )
+@timed("handle_read_all_request")
+def handle_read_all_request(ch, keyspace, correlation_id, reply_to, deadline=None):
+    """Handle a request to read all lines of the file"""
+    # Log the read operation
+    log_operation(replica_id, "READ_ALL", "Full file request", keyspace=keyspace.name)
+
+    # Send each line with its version back to the client, giving up if it
+    # stops waiting
+    for count, line in enumerate(keyspace.store.all_records(), 1):
+        if count % DEADLINE_CHECK_EVERY == 0 and is_expired(deadline):
+            log_operation(
+                replica_id,
+                "EXPIRED",
+                f"Read All abandoned after {count} lines",
+                keyspace=keyspace.name,
+            )
+            return
+        reply(ch, reply_to, correlation_id, line)
 
     # Send an end marker
-    channel.basic_publish(
-        exchange="",
-        routing_key=reply_to,
-        properties=pika.BasicProperties(
-            correlation_id=correlation_id, reply_to=f"replica{replica_id}"
-        ),
-        body="__END__",
+    reply(ch, reply_to, correlation_id, "__END__")
+    print(f"Replica {replica_id} sent all lines from file")
+
+
+@timed("handle_changes_since_request")
+def handle_changes_since_request(ch, keyspace, watermark, correlation_id, reply_to):
+    """Replay the change events newer than a watermark to a subscriber"""
+    log_operation(
+        replica_id, "CHANGES_SINCE", f"Replay after {watermark}", keyspace=keyspace.name
     )
 
-    connection.close()
-    print(f"Replica {replica_id} sent all lines from file")
+    count = 0
+    for event in read_changes_since(keyspace.directory, watermark):
+        reply(ch, reply_to, correlation_id, json.dumps(event))
+        count += 1
 
+    print(f"Replica {replica_id} replayed {count} change(s) after {watermark}")
 
-def callback(ch, method, properties, body):
-    """Callback function for message processing"""
-    message = body.decode()
-    print(f" [x] Replica {replica_id} received {message}")
 
-    if properties.reply_to:
-        # This is a read request
-        if message == "Read Last":
-            handle_read_last_request(
-                replica_id, properties.correlation_id, properties.reply_to
-            )
-        elif message == "Read All":
-            handle_read_all_request(
-                replica_id, properties.correlation_id, properties.reply_to
+def handle_read_request(ch, keyspace, message, properties):
+    """Dispatch a read request unless its client has already given up"""
+    deadline = request_deadline(properties)
+    if is_expired(deadline):
+        print(f"Replica {replica_id} dropped expired request {message}")
+        log_operation(replica_id, "EXPIRED", message, keyspace=keyspace.name)
+        return
+
+    if message == "Read Last":
+        handle_read_last_request(
+            ch, keyspace, properties.correlation_id, properties.reply_to
+        )
+    elif message == "Read All":
+        handle_read_all_request(
+            ch, keyspace, properties.correlation_id, properties.reply_to, deadline
+        )
+    elif message.startswith("Changes Since "):
+        try:
+            watermark = int(message.split(" ", 2)[2])
+        except ValueError:
+            print(f"Invalid watermark in request: {message}")
+        else:
+            handle_changes_since_request(
+                ch, keyspace, watermark, properties.correlation_id, properties.reply_to
             )
+
+
+def handle_fence(keyspace, fence):
+    """Record that every write published before a snapshot fence is applied"""
+    # Commit the writes before the fence so the snapshot only holds durable data
+    if keyspace.commit_timer is not None:
+        keyspace.connection.remove_timeout(keyspace.commit_timer)
+    commit_pending_writes(keyspace)
+    record_fence(
+        keyspace.name,
+        fence,
+        keyspace.store.size,
+        read_applied_watermark(replica_id, keyspace.name),
+    )
+
+    if fence == keyspace.bootstrap_fence:
+        keyspace.bootstrap_fence = None
+        mark_fence_passed(keyspace.directory)
+        log_operation(
+            replica_id,
+            "BOOTSTRAP",
+            "Reached the snapshot fence, applying buffered writes",
+            keyspace=keyspace.name,
+        )
+
+
+@timed("callback")
+def callback(keyspace, ch, method, properties, body):
+    """Callback function for the writes of a keyspace"""
+    message = body.decode()
+    print(f" [x] Replica {replica_id} ({keyspace.name}) received {message}")
+
+    headers = properties.headers or {}
+    if FENCE_HEADER in headers:
+        handle_fence(keyspace, headers[FENCE_HEADER])
+    elif keyspace.bootstrap_fence is not None:
+        # Buffered before the snapshot was taken, so already in the data file
+        print(f"Replica {replica_id} skipped write included in its snapshot")
+    elif not keyspace.store.write_ids.add(headers.get(WRITE_ID_HEADER)):
+        # A client retry of a write this replica already received
+        print(f"Replica {replica_id} skipped duplicate write: {message}")
+        log_operation(
+            replica_id,
+            "DUPLICATE",
+            message,
+            headers.get(WATERMARK_HEADER),
+            keyspace.name,
+        )
     else:
-        # This is a write operation
-        directory = ensure_replica_dir(replica_id)
-        write_to_file(directory, message)
+        # This is a write operation, acked by the group commit
+        watermark = headers.get(WATERMARK_HEADER)
+        version = headers.get(VERSION_HEADER, 0)
+        if valid_version(version):
+            applied = write_to_file(keyspace.store, message, version)
+        else:
+            # Acked without applying it, like a write with a bad line number
+            print(f"Invalid version {version!r}: {message}")
+            applied = False
+        keyspace.pending_writes.append(
+            (method.delivery_tag, message, watermark, version, applied)
+        )
+        schedule_commit(keyspace)
+        return
+
+    ch.basic_ack(delivery_tag=method.delivery_tag)
 
+
+@timed("point_callback")
+def point_callback(keyspace, ch, method, properties, body):
+    """Callback function for the point read lane"""
+    message = body.decode()
+    print(f" [x] Replica {replica_id} ({keyspace.name}) point lane received {message}")
+    handle_read_request(ch, keyspace, message, properties)
+    ch.basic_ack(delivery_tag=method.delivery_tag)
+
+
+@timed("bulk_callback")
+def bulk_callback(keyspace, ch, method, properties, body):
+    """Callback function for the bulk read lane"""
+    message = body.decode()
+    print(f" [x] Replica {replica_id} ({keyspace.name}) bulk lane received {message}")
+    handle_read_request(ch, keyspace, message, properties)
     ch.basic_ack(delivery_tag=method.delivery_tag)
 
 
@@ -188,7 +431,7 @@ def connect_with_retry(max_retries=10, retry_interval=2):
     retries = 0
     while retries < max_retries:
         try:
-            return pika.BlockingConnection(pika.ConnectionParameters("rabbitmq"))
+            return pika.BlockingConnection(pika.ConnectionParameters(RABBITMQ_HOST))
         except pika.exceptions.AMQPConnectionError:
             retries += 1
             print(
@@ -199,43 +442,206 @@ def connect_with_retry(max_retries=10, retry_interval=2):
     raise Exception("Failed to connect to RabbitMQ after multiple attempts")
 
 
-if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print("Usage: python replica.py <replica_id>")
-        sys.exit(1)
+def serve_keyspace(keyspace):
+    """Consume the writes of one keyspace on its own connection"""
+    connection = connect_with_retry()
+    channel = connection.channel()
+    keyspace.connection = connection
+    keyspace.channel = channel
 
-    replica_id = sys.argv[1]
-    log_operation(replica_id, "STARTUP", f"Replica {replica_id} started")
+    # Bound the unacked writes so a group never outgrows the prefetch window
+    channel.basic_qos(prefetch_count=GROUP_COMMIT_MAX_BATCH * 2)
 
-    # Connect to RabbitMQ with retry
-    print(f"Replica {replica_id} connecting to RabbitMQ...")
+    # Applied writes are published on the change feed
+    channel.exchange_declare(exchange=CHANGE_FEED_EXCHANGE, exchange_type="topic")
+
+    # Create a queue for this replica to receive broadcast messages: writes to
+    # the default keyspace are broadcast on the fanout exchange, writes to
+    # named keyspaces are routed by keyspace name
+    queue_name = declare_write_queue(channel, replica_id, keyspace.name)
+    channel.basic_consume(
+        queue=queue_name, on_message_callback=functools.partial(callback, keyspace)
+    )
+
+    print(f" [*] Replica {replica_id} serving keyspace {keyspace.name}")
+    channel.start_consuming()
+
+    # Stopped by the main thread: flush what is left before closing
+    commit_pending_writes(keyspace)
+    keyspace.store.checkpoint()
+    keyspace.store.close()
+    channel.close()
+    connection.close()
+
+
+def serve_point_reads(keyspace):
+    """Serve point reads such as Read Last of a keyspace on their own lane.
+
+    Point reads get their own thread and connection so they never wait
+    behind a group of writes and its fsync on the write lane.
+    """
     connection = connect_with_retry()
     channel = connection.channel()
+    keyspace.point_connection = connection
+    keyspace.point_channel = channel
+
+    channel.basic_qos(prefetch_count=POINT_READ_PREFETCH)
+
+    # Create a queue for direct messages to this replica
+    queue = read_queue(replica_id, keyspace.name)
+    channel.queue_declare(queue=queue, exclusive=False)
+    channel.basic_consume(
+        queue=queue, on_message_callback=functools.partial(point_callback, keyspace)
+    )
 
-    # Set up exchange for broadcasts
-    channel.exchange_declare(exchange="replication_exchange", exchange_type="fanout")
+    print(f" [*] Replica {replica_id} serving point reads of {keyspace.name}")
+    channel.start_consuming()
+    channel.close()
+    connection.close()
 
-    # Create a queue for this replica to receive broadcast messages
-    result = channel.queue_declare(queue=f"replica{replica_id}_queue", exclusive=False)
-    queue_name = result.method.queue
 
-    # Bind to the exchange
-    channel.queue_bind(exchange="replication_exchange", queue=queue_name)
+def serve_bulk_reads(keyspace):
+    """Serve full-scan reads of a keyspace on a separate lane.
 
-    # Create a queue for direct messages to this replica
-    channel.queue_declare(queue=f"replica{replica_id}", exclusive=False)
+    Bulk reads get their own thread and connection so a scan of the whole
+    keyspace never delays the writes or the point reads.
+    """
+    connection = connect_with_retry()
+    channel = connection.channel()
+    keyspace.bulk_connection = connection
+    keyspace.bulk_channel = channel
+
+    # One scan at a time, the others wait in the queue (and may expire there)
+    channel.basic_qos(prefetch_count=1)
+
+    queue = bulk_queue(replica_id, keyspace.name)
+    channel.queue_declare(queue=queue, exclusive=False)
+    channel.basic_consume(
+        queue=queue, on_message_callback=functools.partial(bulk_callback, keyspace)
+    )
+
+    print(f" [*] Replica {replica_id} serving bulk reads of {keyspace.name}")
+    channel.start_consuming()
+    channel.close()
+    connection.close()
+
+
+def serve_snapshot_requests(keyspace):
+    """Serve snapshots of a keyspace to bootstrapping peers on their own lane"""
+    serve_snapshots(replica_id, keyspace.name, keyspace.store, connect_with_retry())
 
-    # Set up consumer for both queues
-    channel.basic_consume(queue=queue_name, on_message_callback=callback)
-    channel.basic_consume(queue=f"replica{replica_id}", on_message_callback=callback)
+
+def serve_control_requests(keyspaces):
+    """Answer diagnostic commands on the replica's control lane"""
+    serve_control(replica_id, keyspaces, connect_with_retry())
+
+
+if __name__ == "__main__":
+    if len(sys.argv) not in (2, 4) or (
+        len(sys.argv) == 4 and sys.argv[2] != "--bootstrap-from"
+    ):
+        print("Usage: python replica.py <replica_id> [--bootstrap-from <replica_id>]")
+        sys.exit(1)
+
+    replica_id = sys.argv[1]
+    if FSYNC_POLICY not in ("always", "interval", "os"):
+        print(f"Unknown FSYNC_POLICY {FSYNC_POLICY!r}, use always, interval or os")
+        sys.exit(1)
+
+    # A new replica first copies the existing data of each keyspace from a
+    # live peer, while its write queues buffer the writes made meanwhile
+    if len(sys.argv) == 4:
+        donor_id = sys.argv[3]
+        for name in configured_keyspaces():
+            watermark = bootstrap_keyspace(
+                replica_id, name, donor_id, connect_with_retry()
+            )
+            log_operation(
+                replica_id,
+                "BOOTSTRAP",
+                f"Keyspace {name} bootstrapped from replica{donor_id} "
+                f"at watermark {watermark}",
+                keyspace=name,
+            )
+
+    keyspaces = [Keyspace(replica_id, name) for name in configured_keyspaces()]
+    for keyspace in keyspaces:
+        log_operation(
+            replica_id,
+            "STARTUP",
+            f"Replica {replica_id} started keyspace {keyspace.name} (replayed "
+            f"{keyspace.store.tail_records} records after the checkpoint in "
+            f"{keyspace.startup_ms:.0f} ms)",
+            keyspace=keyspace.name,
+        )
+
+    # Each keyspace is served by its own thread and connection so a busy
+    # keyspace never holds up the others
+    print(f"Replica {replica_id} connecting to RabbitMQ...")
+    threads = []
+    for keyspace in keyspaces:
+        thread = threading.Thread(
+            target=serve_keyspace, args=(keyspace,), name=keyspace.name, daemon=True
+        )
+        thread.start()
+        threads.append(thread)
+
+    # Point reads, bulk reads and snapshots for bootstrapping peers are
+    # served by separate threads so they never stall the write lanes
+    background_threads = []
+    for keyspace in keyspaces:
+        background_threads.append(
+            threading.Thread(
+                target=serve_point_reads,
+                args=(keyspace,),
+                name=f"{keyspace.name}-reads",
+                daemon=True,
+            )
+        )
+        background_threads.append(
+            threading.Thread(
+                target=serve_bulk_reads,
+                args=(keyspace,),
+                name=f"{keyspace.name}-bulk",
+                daemon=True,
+            )
+        )
+        background_threads.append(
+            threading.Thread(
+                target=serve_snapshot_requests,
+                args=(keyspace,),
+                name=f"{keyspace.name}-snapshots",
+                daemon=True,
+            )
+        )
+    # Diagnostic commands (profiling, timings, memory) get their own lane too
+    background_threads.append(
+        threading.Thread(
+            target=serve_control_requests,
+            args=(keyspaces,),
+            name="control",
+            daemon=True,
+        )
+    )
+    for thread in background_threads:
+        thread.start()
 
     print(f" [*] Replica {replica_id} waiting for messages. To exit press CTRL+C")
     try:
-        channel.start_consuming()
+        # Exit if any keyspace stops so the container gets restarted
+        while all(thread.is_alive() for thread in threads + background_threads):
+            time.sleep(1)
+        print(f"Replica {replica_id} lost a keyspace worker, exiting")
+        sys.exit(1)
     except KeyboardInterrupt:
         print(f"Shutting down Replica {replica_id}")
+        for keyspace in keyspaces:
+            if keyspace.connection is not None and keyspace.connection.is_open:
+                keyspace.connection.add_callback_threadsafe(
+                    keyspace.channel.stop_consuming
+                )
+        for thread in threads:
+            thread.join(timeout=10)
         log_operation(
             replica_id, "SHUTDOWN", f"Replica {replica_id} shutdown gracefully"
         )
-        channel.close()
-        connection.close()
@@ -0,0 +1,395 @@
+import os
+import mmap
+import struct
+import threading
+from versions import newer, valid_version
+from write_ids import RecentWriteIds
+
+# Checkpoint layout: a header followed by entries sorted by line number
+CHECKPOINT_MAGIC = b"RIDX"
+CHECKPOINT_VERSION = 2
+# magic, version, entry count, bytes of data.txt covered by the checkpoint
+CHECKPOINT_HEADER = struct.Struct("<4sIQQ")
+# line number, record offset in data.txt, record length (without newline),
+# line version
+CHECKPOINT_ENTRY = struct.Struct("<qQIQ")
+
+
+def format_record(line_number, version, content):
+    """Stored form of a line, "<line number>@<version> <content>" """
+    return f"{line_number}@{version} {content}"
+
+
+def parse_record(record):
+    """Split a stored record into (line number, version, content).
+
+    Records written before lines were versioned ("<line number> <content>")
+    have version 0. Returns None for invalid records.
+    """
+    parts = record.strip().split(" ", 1)
+    if len(parts) != 2:
+        return None
+    number, _, version = parts[0].partition("@")
+    try:
+        number, version = int(number), int(version or 0)
+    except ValueError:
+        return None
+    if not valid_version(version):
+        return None
+    return number, version, parts[1]
+
+
+def read_data_records(file_path):
+    """Return {line number: (version, content)} for the winning record of each line"""
+    lines = {}
+    if os.path.exists(file_path):
+        with open(file_path, "r") as file:
+            for record in file:
+                parsed = parse_record(record)
+                if parsed is None:
+                    continue
+                number, version, content = parsed
+                if number not in lines or newer(version, content, *lines[number]):
+                    lines[number] = (version, content)
+    return lines
+
+
+def read_data_file(file_path):
+    """Return the lines of a data file sorted by line number.
+
+    Each line shows the content of its latest version, as for the replicas.
+    """
+    lines = read_data_records(file_path)
+    return [f"{number} {content}" for number, (_, content) in sorted(lines.items())]
+
+
+class IndexCheckpoint:
+    """A memory-mapped `index.ckpt`, searched in place.
+
+    A checkpoint file is never modified once written, so a reader may keep
+    using one without the store lock even after a newer checkpoint replaced
+    it; the mapping is released once the last reader drops it.
+    """
+
+    def __init__(self, mapping, count, offset):
+        self.mapping = mapping
+        self.count = count
+        self.offset = offset  # bytes of data.txt covered by the checkpoint
+
+    @classmethod
+    def load(cls, path, data_size):
+        """Map a checkpoint, or return None if it is missing or not valid for
+        a data file of `data_size` bytes"""
+        if not os.path.exists(path):
+            return None
+
+        with open(path, "rb") as file:
+            try:
+                mapping = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:  # empty file
+                return None
+
+        valid = len(mapping) >= CHECKPOINT_HEADER.size
+        if valid:
+            magic, version, count, offset = CHECKPOINT_HEADER.unpack_from(mapping)
+            valid = (
+                magic == CHECKPOINT_MAGIC
+                and version == CHECKPOINT_VERSION
+                and len(mapping)
+                == CHECKPOINT_HEADER.size + count * CHECKPOINT_ENTRY.size
+                and offset <= data_size
+            )
+        if not valid:
+            print(f"Ignoring invalid checkpoint {path}")
+            mapping.close()
+            return None
+        return cls(mapping, count, offset)
+
+    def entry(self, position):
+        """(line number, offset, length, version) of an entry"""
+        return CHECKPOINT_ENTRY.unpack_from(
+            self.mapping, CHECKPOINT_HEADER.size + position * CHECKPOINT_ENTRY.size
+        )
+
+    def position(self, line_number, low=0):
+        """Position of the first entry at or after a line number"""
+        high = self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.entry(middle)[0] < line_number:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def lookup(self, line_number):
+        """Binary search the checkpoint for the location of a line"""
+        position = self.position(line_number)
+        if position < self.count:
+            number, offset, length, version = self.entry(position)
+            if number == line_number:
+                return offset, length, version
+        return None
+
+    def raw_entries(self, start, stop):
+        """Packed bytes of the entries in [start, stop)"""
+        return self.mapping[
+            CHECKPOINT_HEADER.size
+            + start * CHECKPOINT_ENTRY.size : CHECKPOINT_HEADER.size
+            + stop * CHECKPOINT_ENTRY.size
+        ]
+
+    def entries(self):
+        """Iterate over every entry in line number order"""
+        return CHECKPOINT_ENTRY.iter_unpack(self.raw_entries(0, self.count))
+
+
+def _merge_locations(entries, tail):
+    """Merge checkpoint entries with sorted (line number, location) tail items.
+
+    Yields (line number, location) in line number order; a line in the tail
+    replaces its checkpointed entry.
+    """
+    tail = iter(tail)
+    pending = next(tail, None)
+    for number, offset, length, version in entries:
+        while pending is not None and pending[0] < number:
+            yield pending
+            pending = next(tail, None)
+        if pending is not None and pending[0] == number:
+            continue
+        yield number, (offset, length, version)
+    while pending is not None:
+        yield pending
+        pending = next(tail, None)
+
+
+class ReplicaStore:
+    """Append-only data file with an index of where each line is stored.
+
+    Writes are appended to `data.txt` and only become durable once `commit`
+    is called, which lets the replica group several writes under one fsync.
+    Each line is versioned and the highest version wins (last-writer-wins):
+    an update appends a new record and the index moves to it.
+
+    The index is periodically checkpointed to `index.ckpt`, a sorted array of
+    fixed-size (line number, offset, length, version) entries that is
+    memory-mapped and searched in place (see `IndexCheckpoint`). Only the
+    records appended to `data.txt` after the checkpoint are parsed again, so
+    startup time does not grow with the size of the data. A new checkpoint
+    is merged from the previous one and the lines written since, outside
+    the lock.
+
+    The ids of recently applied writes are kept alongside the data (see
+    `RecentWriteIds`) so retried writes can be recognised.
+
+    The index is guarded by a lock, held only for lookups and to copy the
+    tail: a scan merges that copy with the immutable checkpoint outside it,
+    so the bulk read lane never holds up writes or point reads. Record bytes
+    are never rewritten, so they can be read without holding it either.
+    """
+
+    def __init__(self, directory):
+        self.file_path = f"{directory}/data.txt"
+        self.checkpoint_path = f"{directory}/index.ckpt"
+
+        self.lock = threading.RLock()
+        # line number -> (offset, length, version) since the checkpoint
+        self.tail = {}
+        self.max_line = None
+        self.checkpoint_offset = 0  # bytes of data.txt covered by the checkpoint
+        # Records appended after the checkpoint, updates to a line included
+        self.tail_records = 0
+        self._checkpoint = None
+
+        self._fd = os.open(self.file_path, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+        self.size = os.fstat(self._fd).st_size
+
+        self._load_checkpoint()
+        self._replay_tail()
+        self.write_ids = RecentWriteIds(directory)
+
+    # ---- Startup ----
+
+    def _load_checkpoint(self):
+        """Map the checkpoint if it is valid for the current data file"""
+        self._checkpoint = IndexCheckpoint.load(self.checkpoint_path, self.size)
+        if self._checkpoint is None:
+            # Rebuild the index from the whole data file
+            return
+        self.checkpoint_offset = self._checkpoint.offset
+        if self._checkpoint.count:
+            self.max_line = self._checkpoint.entry(self._checkpoint.count - 1)[0]
+
+    def _replay_tail(self):
+        """Index the records appended after the checkpoint"""
+        with open(self.file_path, "rb") as file:
+            file.seek(self.checkpoint_offset)
+            offset = self.checkpoint_offset
+            for record in file:
+                if not record.endswith(b"\n"):
+                    # Drop a record torn by a crash, it was never acknowledged
+                    os.ftruncate(self._fd, offset)
+                    self.size = offset
+                    break
+                self.tail_records += 1
+                parsed = parse_record(record.decode(errors="replace"))
+                if parsed and self._wins(*parsed):
+                    number, version, _ = parsed
+                    self._index(number, offset, len(record) - 1, version)
+                offset += len(record)
+
+    # ---- Index ----
+
+    def _locate(self, line_number):
+        location = self.tail.get(line_number)
+        if location is None and self._checkpoint is not None:
+            location = self._checkpoint.lookup(line_number)
+        return location
+
+    def _index(self, line_number, offset, length, version):
+        self.tail[line_number] = (offset, length, version)
+        if self.max_line is None or line_number > self.max_line:
+            self.max_line = line_number
+
+    def _read_record(self, location):
+        offset, length, _ = location
+        return os.pread(self._fd, length, offset).decode(errors="replace")
+
+    def _wins(self, line_number, version, content):
+        """Whether a value would replace the current one of its line"""
+        location = self._locate(line_number)
+        if location is None:
+            return True
+        if version != location[2]:
+            return version > location[2]
+        # Same version: only then is the current content needed
+        current = parse_record(self._read_record(location))
+        return current is None or newer(version, content, current[1], current[2])
+
+    # ---- Reads and writes ----
+
+    def apply(self, line_number, content, version=0):
+        """Append a line unless it already has a newer (or the same) version"""
+        if not valid_version(version):
+            raise ValueError(f"Invalid version {version!r}")
+        with self.lock:
+            if not self._wins(line_number, version, content):
+                return False
+            record = f"{format_record(line_number, version, content)}\n".encode()
+            offset = self.size
+            os.write(self._fd, record)
+            self.size += len(record)
+            self.tail_records += 1
+            self._index(line_number, offset, len(record) - 1, version)
+            return True
+
+    def commit(self, fsync=True):
+        """Make the appended writes durable (they are already visible to reads)"""
+        if fsync:
+            os.fsync(self._fd)
+        # Ids are persisted after their writes so an id never outlives its write
+        self.write_ids.commit(fsync)
+
+    def read_line(self, line_number):
+        """Return the current value of a line as "<line number> <content>" """
+        with self.lock:
+            location = self._locate(line_number)
+        if location is None:
+            return None
+        parsed = parse_record(self._read_record(location))
+        return None if parsed is None else f"{parsed[0]} {parsed[2]}"
+
+    def last_line(self):
+        with self.lock:
+            if self.max_line is None:
+                return ""
+            return self.read_line(self.max_line)
+
+    def all_records(self):
+        """Yield the stored record of every line, with its version, in order"""
+        with self.lock:
+            checkpoint = self._checkpoint
+            tail = list(self.tail.items())
+        tail.sort()
+
+        entries = checkpoint.entries() if checkpoint is not None else ()
+        for _, location in _merge_locations(entries, tail):
+            yield self._read_record(location)
+
+    # ---- Checkpoints ----
+
+    def checkpoint(self):
+        """Write a new checkpoint covering the data file, returning its size.
+
+        Only the tail is copied under the lock. The new file is merged from
+        that copy and the previous checkpoint, which is immutable, and then
+        swapped in under the lock, so reads and writes are not held up by it.
+        """
+        with self.lock:
+            checkpoint = self._checkpoint
+            tail = dict(self.tail)
+            tail_records = self.tail_records
+            size = self.size
+        self.commit()
+
+        count = self._write_checkpoint(checkpoint, sorted(tail.items()), size)
+        new_checkpoint = IndexCheckpoint.load(self.checkpoint_path, size)
+
+        with self.lock:
+            self._checkpoint = new_checkpoint
+            self.checkpoint_offset = size
+            # Lines written during the merge stay in the tail
+            for number, location in tail.items():
+                if self.tail.get(number) == location:
+                    del self.tail[number]
+            self.tail_records -= tail_records
+        return count
+
+    def _write_checkpoint(self, checkpoint, tail, size):
+        """Merge sorted tail entries into a copy of a checkpoint.
+
+        The runs of entries between two tail lines are copied as raw bytes,
+        so the cost is one pass over the file plus a search per tail line.
+        """
+        tmp_path = f"{self.checkpoint_path}.tmp"
+        count = 0
+        position = 0
+        with open(tmp_path, "wb") as file:
+            file.seek(CHECKPOINT_HEADER.size)
+            for number, (offset, length, version) in tail:
+                if checkpoint is not None:
+                    next_position = checkpoint.position(number, position)
+                    file.write(checkpoint.raw_entries(position, next_position))
+                    count += next_position - position
+                    position = next_position
+                    # The tail entry replaces the checkpointed one of its line
+                    if (
+                        position < checkpoint.count
+                        and checkpoint.entry(position)[0] == number
+                    ):
+                        position += 1
+                file.write(CHECKPOINT_ENTRY.pack(number, offset, length, version))
+                count += 1
+            if checkpoint is not None:
+                file.write(checkpoint.raw_entries(position, checkpoint.count))
+                count += checkpoint.count - position
+
+            file.seek(0)
+            file.write(
+                CHECKPOINT_HEADER.pack(
+                    CHECKPOINT_MAGIC, CHECKPOINT_VERSION, count, size
+                )
+            )
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, self.checkpoint_path)
+        return count
+
+    def close(self):
+        with self.lock:
+            self.commit()
+            # Readers still holding the checkpoint keep its mapping alive
+            self._checkpoint = None
+            self.write_ids.close()
+            os.close(self._fd)
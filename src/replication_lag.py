@@ -0,0 +1,274 @@
+import os
+import json
+import time
+import bisect
+import threading
+from datetime import datetime
+from keyspaces import DEFAULT_KEYSPACE, keyspace_dir
+from settings import REPLICAS_DIR
+
+# AMQP header carrying the write watermark stamped by the writer
+WATERMARK_HEADER = "watermark"
+# Writes covered by a lag history, from the most recent one
+LAG_HISTORY_WINDOW = 1000
+# Stamped watermarks cached per keyspace; a replica further behind than this
+# is reported with this lag
+MAX_STAMPED_WATERMARKS = 100000
+
+_watermark_lock = threading.Lock()
+_last_watermark = 0
+
+_stamped_lock = threading.Lock()
+_stamped_logs = {}  # log file -> inode, parsed offset and watermarks per keyspace
+
+
+def next_watermark():
+    """Return a new write watermark.
+
+    Watermarks are microsecond timestamps taken on the writer, bumped so they
+    are strictly increasing within a process. Because they encode the time of
+    the write, lag in seconds can be derived from them directly.
+    """
+    global _last_watermark
+    with _watermark_lock:
+        _last_watermark = max(_last_watermark + 1, time.time_ns() // 1000)
+        return _last_watermark
+
+
+def watermark_to_seconds(watermark):
+    """Convert a watermark back to a UNIX timestamp"""
+    return watermark / 1_000_000
+
+
+def watermark_file(replica_id, keyspace=DEFAULT_KEYSPACE):
+    return f"{keyspace_dir(replica_id, keyspace)}/watermark.json"
+
+
+def record_applied_watermark(replica_id, watermark, keyspace=DEFAULT_KEYSPACE):
+    """Persist the highest watermark a replica has applied to a keyspace"""
+    current = read_applied_watermark(replica_id, keyspace)
+    if watermark <= current:
+        return current
+
+    file_path = watermark_file(replica_id, keyspace)
+    tmp_path = f"{file_path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"watermark": watermark, "applied_at": datetime.now().isoformat()}, f)
+    os.replace(tmp_path, file_path)
+    return watermark
+
+
+def read_applied_watermark(replica_id, keyspace=DEFAULT_KEYSPACE):
+    """Return the highest watermark applied by a replica (0 if unknown)"""
+    file_path = watermark_file(replica_id, keyspace)
+    if not os.path.exists(file_path):
+        return 0
+    try:
+        with open(file_path, "r") as f:
+            return int(json.load(f).get("watermark", 0))
+    except (ValueError, json.JSONDecodeError):
+        return 0
+
+
+def _is_watermarked_write(entry, keyspace):
+    return (
+        entry.get("operation") == "WRITE"
+        and entry.get("watermark")
+        and entry.get("keyspace", DEFAULT_KEYSPACE) == keyspace
+    )
+
+
+def _insert_sorted(watermarks, watermark):
+    # Writes are logged almost in watermark order, so this is nearly always
+    # an append
+    if not watermarks or watermark >= watermarks[-1]:
+        watermarks.append(watermark)
+    else:
+        bisect.insort(watermarks, watermark)
+
+
+def _stamped_watermarks(keyspace, log_file):
+    """Sorted stamped watermarks of a keyspace, parsing only the new log lines.
+
+    Must be called with `_stamped_lock` held; the list is updated in place
+    and keeps at most the last MAX_STAMPED_WATERMARKS watermarks.
+    """
+    try:
+        stat = os.stat(log_file)
+    except FileNotFoundError:
+        return []
+
+    cached = _stamped_logs.get(log_file)
+    if (
+        cached is None
+        or cached["inode"] != stat.st_ino
+        or stat.st_size < cached["offset"]
+    ):
+        # First read, or the log was replaced or truncated
+        cached = _stamped_logs[log_file] = {
+            "inode": stat.st_ino,
+            "offset": 0,
+            "watermarks": {},
+        }
+
+    if stat.st_size > cached["offset"]:
+        with open(log_file, "rb") as f:
+            f.seek(cached["offset"])
+            data = f.read(stat.st_size - cached["offset"])
+        # A line still being written is parsed on the next call
+        end = data.rfind(b"\n") + 1
+        cached["offset"] += end
+        for line in data[:end].splitlines():
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            entry_keyspace = entry.get("keyspace", DEFAULT_KEYSPACE)
+            if _is_watermarked_write(entry, entry_keyspace):
+                _insert_sorted(
+                    cached["watermarks"].setdefault(entry_keyspace, []),
+                    int(entry["watermark"]),
+                )
+        for watermarks in cached["watermarks"].values():
+            del watermarks[:-MAX_STAMPED_WATERMARKS]
+    return cached["watermarks"].get(keyspace, [])
+
+
+def read_stamped_watermarks(
+    keyspace=DEFAULT_KEYSPACE, log_file=f"{REPLICAS_DIR}/client_operations.log"
+):
+    """Return the sorted watermarks of the writes logged to a keyspace.
+
+    Writes that `compute_replica_lag` found applied by every replica, and
+    any beyond the last MAX_STAMPED_WATERMARKS, are left out.
+    """
+    with _stamped_lock:
+        return list(_stamped_watermarks(keyspace, log_file))
+
+
+def _lag(stamped, applied, now):
+    """Lag of a replica at `applied` given the sorted stamped watermarks"""
+    first_unapplied = bisect.bisect_right(stamped, applied)
+    lag_writes = len(stamped) - first_unapplied
+    if lag_writes == 0:
+        return 0, 0.0
+    oldest = watermark_to_seconds(stamped[first_unapplied])
+    return lag_writes, max(0.0, now - oldest)
+
+
+def compute_replica_lag(
+    replica_ids=range(1, 4),
+    now=None,
+    keyspace=DEFAULT_KEYSPACE,
+    applied_watermarks=None,
+):
+    """Compute the live lag of each replica in writes and seconds.
+
+    The lag is measured against the watermarks stamped by the writers. The
+    watermark each replica applied is read from its watermark file, unless
+    the caller already follows them and passes {replica id: watermark}.
+    Stamped watermarks that every given replica has applied are no longer
+    needed and are dropped from the cache.
+    """
+    now = time.time() if now is None else now
+
+    lag = {}
+    with _stamped_lock:
+        stamped = _stamped_watermarks(keyspace, f"{REPLICAS_DIR}/client_operations.log")
+        for replica_id in replica_ids:
+            if applied_watermarks is None:
+                applied = read_applied_watermark(replica_id, keyspace)
+            else:
+                applied = applied_watermarks[replica_id]
+            lag_writes, lag_seconds = _lag(stamped, applied, now)
+            lag[f"replica{replica_id}"] = {
+                "applied_watermark": applied,
+                "lag_writes": lag_writes,
+                "lag_seconds": lag_seconds,
+            }
+
+        if lag:
+            slowest = min(
+                replica_lag["applied_watermark"] for replica_lag in lag.values()
+            )
+            del stamped[: bisect.bisect_right(stamped, slowest)]
+    return lag
+
+
+def replicas_within_lag(
+    max_lag_writes=None,
+    max_lag_seconds=None,
+    replica_ids=range(1, 4),
+    keyspace=DEFAULT_KEYSPACE,
+):
+    """Return the replica ids whose lag is within the given thresholds.
+
+    If every replica exceeds the thresholds, all of them are returned so that
+    reads degrade to the old behaviour rather than failing outright.
+    """
+    replica_ids = list(replica_ids)
+    if max_lag_writes is None and max_lag_seconds is None:
+        return replica_ids
+
+    lag = compute_replica_lag(replica_ids, keyspace=keyspace)
+    eligible = []
+    for replica_id in replica_ids:
+        replica_lag = lag[f"replica{replica_id}"]
+        if max_lag_writes is not None and replica_lag["lag_writes"] > max_lag_writes:
+            continue
+        if max_lag_seconds is not None and replica_lag["lag_seconds"] > max_lag_seconds:
+            continue
+        eligible.append(replica_id)
+
+    if not eligible:
+        print("All replicas exceed the lag threshold, reading from all of them")
+        return replica_ids
+    return eligible
+
+
+def lag_history(
+    client_logs, replica_logs, keyspace=DEFAULT_KEYSPACE, window=LAG_HISTORY_WINDOW
+):
+    """Rebuild per-replica lag over time from the operation logs.
+
+    Returns one sample per replica at each of the last `window` logged writes
+    (client or replica) as dicts with `timestamp`, `replica`, `lag_writes`
+    and `lag_seconds`.
+    """
+    events = []
+    for entry in client_logs:
+        if _is_watermarked_write(entry, keyspace):
+            events.append((entry["timestamp"], None, int(entry["watermark"])))
+    for entry in replica_logs:
+        if _is_watermarked_write(entry, keyspace):
+            events.append(
+                (entry["timestamp"], entry["replica"], int(entry["watermark"]))
+            )
+    events.sort(key=lambda event: event[0])
+
+    replicas = sorted({replica for _, replica, _ in events if replica})
+    applied = {replica: 0 for replica in replicas}
+    stamped = []
+    history = []
+
+    first_sample = len(events) - window
+    for index, (timestamp, replica, watermark) in enumerate(events):
+        if replica is None:
+            _insert_sorted(stamped, watermark)
+        else:
+            applied[replica] = max(applied[replica], watermark)
+        if index < first_sample:
+            continue
+
+        now = datetime.fromisoformat(timestamp).timestamp()
+        for name in replicas:
+            lag_writes, lag_seconds = _lag(stamped, applied[name], now)
+            history.append(
+                {
+                    "timestamp": timestamp,
+                    "replica": name,
+                    "lag_writes": lag_writes,
+                    "lag_seconds": lag_seconds,
+                }
+            )
+    return history
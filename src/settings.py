@@ -0,0 +1,7 @@
+import os
+
+# Host of the RabbitMQ broker
+RABBITMQ_HOST = os.environ.get("RABBITMQ_HOST", "rabbitmq")
+
+# Directory holding the replica data and the operation logs
+REPLICAS_DIR = os.environ.get("REPLICAS_DIR", "/app/replicas")
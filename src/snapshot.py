@@ -0,0 +1,282 @@
+import pika
+import os
+import json
+import uuid
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from keyspaces import declare_write_queue, keyspace_dir, snapshot_queue, write_target
+from replication_lag import record_applied_watermark
+
+# Bytes of the data file sent per snapshot chunk
+SNAPSHOT_CHUNK_SIZE = 256 * 1024
+# Seconds to wait for a reply from the donor before retrying
+SNAPSHOT_REQUEST_TIMEOUT = 10.0
+SNAPSHOT_MAX_RETRIES = 5
+
+# AMQP header of the fence a bootstrapping replica publishes through the
+# write exchange: a donor answers for the snapshot once it has applied it
+FENCE_HEADER = "snapshot_fence"
+# Seconds a donor waits for a fence before asking the requester to retry
+SNAPSHOT_FENCE_WAIT = 5.0
+# Fences remembered per replica
+MAX_FENCES = 64
+
+_fences_condition = threading.Condition()
+_fences = OrderedDict()  # (keyspace, fence) -> (data file size, watermark)
+
+
+def record_fence(keyspace, fence, size, watermark):
+    """Note that a keyspace applied every write published before a fence"""
+    with _fences_condition:
+        _fences[(keyspace, fence)] = (size, watermark)
+        while len(_fences) > MAX_FENCES:
+            _fences.popitem(last=False)
+        _fences_condition.notify_all()
+
+
+def _wait_for_fence(keyspace, fence, timeout):
+    with _fences_condition:
+        _fences_condition.wait_for(lambda: (keyspace, fence) in _fences, timeout)
+        return _fences.get((keyspace, fence))
+
+
+def serve_snapshots(replica_id, keyspace, store, connection):
+    """Serve snapshot requests for a keyspace on a dedicated connection.
+
+    The data file is append-only, so any prefix of it is a consistent
+    snapshot that later writes never modify. Chunks are read with their own
+    file descriptor on this thread, which keeps a bootstrap off the
+    replica's normal serving path. Invalid requests are rejected one by one
+    so they cannot stop the thread.
+    """
+    channel = connection.channel()
+    queue = snapshot_queue(replica_id, keyspace)
+    channel.queue_declare(queue=queue, exclusive=False)
+    channel.basic_qos(prefetch_count=1)
+
+    fd = os.open(store.file_path, os.O_RDONLY)
+
+    def respond_to(request):
+        if request["type"] == "info":
+            # The snapshot covers every write published before the fence
+            fenced = _wait_for_fence(keyspace, request["fence"], SNAPSHOT_FENCE_WAIT)
+            if fenced is None:
+                return json.dumps({"fence_reached": False}).encode(), {}
+            size, watermark = fenced
+            response = json.dumps({"size": size, "watermark": watermark}).encode()
+            print(f"Replica {replica_id} offering snapshot of {keyspace}: {response}")
+            return response, {}
+
+        if request["type"] != "chunk":
+            raise ValueError(f"unknown request type {request['type']!r}")
+        offset = int(request["offset"])
+        length = max(0, min(int(request["length"]), int(request["size"]) - offset))
+        response = os.pread(fd, length, offset)
+        return response, {
+            "offset": offset,
+            "sha256": hashlib.sha256(response).hexdigest(),
+        }
+
+    def on_request(ch, method, props, body):
+        try:
+            response, headers = respond_to(json.loads(body))
+        except Exception as e:
+            print(f"Replica {replica_id} rejected snapshot request {body!r}: {e}")
+            ch.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
+            return
+
+        if not props.reply_to:
+            print(f"Replica {replica_id} dropped snapshot request without reply_to")
+            ch.basic_ack(delivery_tag=method.delivery_tag)
+            return
+        ch.basic_publish(
+            exchange="",
+            routing_key=props.reply_to,
+            properties=pika.BasicProperties(
+                correlation_id=props.correlation_id, headers=headers
+            ),
+            body=response,
+        )
+        ch.basic_ack(delivery_tag=method.delivery_tag)
+
+    channel.basic_consume(queue=queue, on_message_callback=on_request)
+    try:
+        channel.start_consuming()
+    finally:
+        os.close(fd)
+
+
+def _progress_file(directory):
+    return f"{directory}/bootstrap.json"
+
+
+def _save_progress(directory, progress):
+    tmp_path = f"{_progress_file(directory)}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(progress, f)
+    os.replace(tmp_path, _progress_file(directory))
+
+
+def _load_progress(directory):
+    if not os.path.exists(_progress_file(directory)):
+        return None
+    with open(_progress_file(directory), "r") as f:
+        return json.load(f)
+
+
+def pending_bootstrap_fence(directory):
+    """Fence up to which buffered writes are already in the snapshot, if any"""
+    progress = _load_progress(directory)
+    if progress and progress["complete"] and not progress.get("fence_passed"):
+        return progress.get("fence")
+    return None
+
+
+def mark_fence_passed(directory):
+    """Record that the replica consumed its fence and now applies every write"""
+    progress = _load_progress(directory)
+    progress["fence_passed"] = True
+    _save_progress(directory, progress)
+
+
+def bootstrap_keyspace(replica_id, keyspace, donor_id, connection):
+    """Copy a consistent snapshot of a keyspace from a donor replica.
+
+    The replica's write queue is declared first so that live writes are
+    buffered by RabbitMQ during the transfer, then a fence is published
+    through the write exchange. The donor takes the snapshot once it has
+    applied the fence, so every write is either in the snapshot (published
+    before the fence) or buffered after the fence in the new queue; the
+    writes buffered before it are skipped (see `pending_bootstrap_fence`).
+
+    The snapshot is pulled in checksummed chunks and progress is saved after
+    each one, so an interrupted bootstrap resumes where it stopped. Returns
+    the snapshot watermark.
+    """
+    directory = keyspace_dir(replica_id, keyspace)
+    os.makedirs(directory, exist_ok=True)
+    data_path = f"{directory}/data.txt"
+
+    progress = _load_progress(directory)
+    if progress and progress["complete"]:
+        print(
+            f"Keyspace {keyspace} already bootstrapped from replica{progress['donor']}"
+        )
+        connection.close()
+        return progress["watermark"]
+    if progress is None and os.path.exists(data_path) and os.path.getsize(data_path):
+        print(f"Keyspace {keyspace} already has data, not bootstrapping it")
+        connection.close()
+        return None
+
+    channel = connection.channel()
+
+    # Start buffering live writes before the snapshot is taken
+    declare_write_queue(channel, replica_id, keyspace)
+
+    result = channel.queue_declare(queue="", exclusive=True)
+    callback_queue = result.method.queue
+    replies = {}
+
+    def on_reply(ch, method, props, body):
+        replies[props.correlation_id] = (props, body)
+
+    channel.basic_consume(
+        queue=callback_queue, on_message_callback=on_reply, auto_ack=True
+    )
+
+    def call(request):
+        for attempt in range(1, SNAPSHOT_MAX_RETRIES + 1):
+            correlation_id = str(uuid.uuid4())
+            channel.basic_publish(
+                exchange="",
+                routing_key=snapshot_queue(donor_id, keyspace),
+                properties=pika.BasicProperties(
+                    reply_to=callback_queue, correlation_id=correlation_id
+                ),
+                body=json.dumps(request),
+            )
+            deadline = time.time() + SNAPSHOT_REQUEST_TIMEOUT
+            while time.time() < deadline and correlation_id not in replies:
+                connection.process_data_events(time_limit=0.1)
+
+            if correlation_id not in replies:
+                print(f"Snapshot request timed out (attempt {attempt})")
+                continue
+            props, body = replies.pop(correlation_id)
+            if request["type"] == "chunk" and (
+                props.headers["offset"] != request["offset"]
+                or hashlib.sha256(body).hexdigest() != props.headers["sha256"]
+            ):
+                print(
+                    f"Chunk at {request['offset']} failed its checksum (attempt {attempt})"
+                )
+                continue
+            return body
+        raise Exception(f"Snapshot request to replica{donor_id} failed: {request}")
+
+    if progress is None:
+        # Every write published before the fence reaches the donor first
+        fence = str(uuid.uuid4())
+        exchange, routing_key = write_target(keyspace)
+        channel.basic_publish(
+            exchange=exchange,
+            routing_key=routing_key,
+            properties=pika.BasicProperties(headers={FENCE_HEADER: fence}),
+            body=b"",
+        )
+
+        for attempt in range(1, SNAPSHOT_MAX_RETRIES + 1):
+            info = json.loads(call({"type": "info", "fence": fence}))
+            if "size" in info:
+                break
+            print(
+                f"Replica{donor_id} has not reached the fence yet (attempt {attempt})"
+            )
+        else:
+            raise Exception(f"Replica{donor_id} never reached the snapshot fence")
+
+        progress = {
+            "donor": donor_id,
+            "size": info["size"],
+            "watermark": info["watermark"],
+            "fence": fence,
+            "offset": 0,
+            "complete": False,
+        }
+        _save_progress(directory, progress)
+    print(f"Bootstrapping keyspace {keyspace} from replica{donor_id}: {progress}")
+
+    # Drop anything written past the last verified chunk
+    with open(data_path, "ab") as data_file:
+        data_file.truncate(progress["offset"])
+
+        while progress["offset"] < progress["size"]:
+            chunk = call(
+                {
+                    "type": "chunk",
+                    "offset": progress["offset"],
+                    "length": SNAPSHOT_CHUNK_SIZE,
+                    "size": progress["size"],
+                }
+            )
+            if not chunk:
+                raise Exception(f"Replica{donor_id} returned an empty snapshot chunk")
+            data_file.write(chunk)
+            data_file.flush()
+            os.fsync(data_file.fileno())
+
+            progress["offset"] += len(chunk)
+            _save_progress(directory, progress)
+
+    # Writes up to the snapshot watermark are now part of the data file
+    if progress["watermark"]:
+        record_applied_watermark(replica_id, progress["watermark"], keyspace)
+    progress["complete"] = True
+    _save_progress(directory, progress)
+
+    connection.close()
+    print(f"Keyspace {keyspace} bootstrapped at watermark {progress['watermark']}")
+    return progress["watermark"]
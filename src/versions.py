@@ -0,0 +1,49 @@
+import time
+import threading
+
+# AMQP header carrying the version of a write
+VERSION_HEADER = "version"
+# Versions are stored as unsigned 64-bit integers in the index checkpoint
+MAX_VERSION = 2**64 - 1
+
+_clock_lock = threading.Lock()
+_last_version = 0
+
+
+def next_version():
+    """Return a new line version from this process's hybrid logical clock.
+
+    Versions are microsecond timestamps, bumped so they are strictly
+    increasing within the process and above every version it has observed.
+    A write therefore always wins over the versions its writer has read,
+    even if that writer's clock is behind the one that produced them.
+    """
+    global _last_version
+    with _clock_lock:
+        _last_version = max(_last_version + 1, time.time_ns() // 1000)
+        return _last_version
+
+
+def valid_version(version):
+    """Whether a version can be stored, i.e. an integer in [0, 2**64)"""
+    return (
+        isinstance(version, int)
+        and not isinstance(version, bool)
+        and 0 <= version <= MAX_VERSION
+    )
+
+
+def observe_version(version):
+    """Advance the clock past a version read from a replica"""
+    global _last_version
+    with _clock_lock:
+        _last_version = max(_last_version, version)
+
+
+def newer(version, content, other_version, other_content):
+    """Whether (version, content) wins over the other value of a line.
+
+    The highest version wins; equal versions from different writers are
+    ordered by content so that every replica settles on the same value.
+    """
+    return (version, content) > (other_version, other_content)
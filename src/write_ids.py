@@ -0,0 +1,114 @@
+import os
+import uuid
+import hashlib
+from collections import deque
+
+# AMQP header carrying the client-generated id of a write
+WRITE_ID_HEADER = "write_id"
+
+# Number of recent write ids each keyspace remembers. A retry is recognised as
+# long as fewer than this many writes reached the replica since the original.
+WRITE_ID_WINDOW = int(os.environ.get("WRITE_ID_WINDOW", "100000"))
+
+# Ids are stored as fixed-size digests, whatever their original form
+WRITE_ID_SIZE = 16
+
+
+def new_write_id():
+    """Return a new write id, reused by every retry of the same write"""
+    return uuid.uuid4().hex
+
+
+def _digest(write_id):
+    if isinstance(write_id, str):
+        write_id = write_id.encode()
+    return hashlib.blake2b(write_id, digest_size=WRITE_ID_SIZE).digest()
+
+
+class RecentWriteIds:
+    """Bounded filter of the most recent write ids of a keyspace.
+
+    Ids are kept as 16-byte digests in a set for lookups and a deque for
+    eviction order, so memory stays around 100 bytes per remembered id. They
+    are persisted next to the data in `write_ids.bin`, an append-only file of
+    fixed-size records of which the last `capacity` are loaded on startup.
+
+    New ids are only written to the file by `commit`, which the store calls
+    after the data itself is durable: an id must never survive a crash that
+    lost its write, or the redelivered write would be dropped as a duplicate.
+    """
+
+    def __init__(self, directory, capacity=WRITE_ID_WINDOW):
+        self.file_path = f"{directory}/write_ids.bin"
+        self.capacity = capacity
+        self._ids = set()
+        self._order = deque()
+        self._uncommitted = []
+
+        self._fd = os.open(self.file_path, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+        self._load()
+
+    def _load(self):
+        size = os.fstat(self._fd).st_size
+        # Drop a record torn by a crash
+        self._records = size // WRITE_ID_SIZE
+        if size != self._records * WRITE_ID_SIZE:
+            os.ftruncate(self._fd, self._records * WRITE_ID_SIZE)
+
+        start = max(0, self._records - self.capacity) * WRITE_ID_SIZE
+        data = os.pread(self._fd, self._records * WRITE_ID_SIZE - start, start)
+        for offset in range(0, len(data), WRITE_ID_SIZE):
+            self._remember(data[offset : offset + WRITE_ID_SIZE])
+
+    def _remember(self, digest):
+        if len(self._order) >= self.capacity:
+            self._ids.discard(self._order.popleft())
+        self._ids.add(digest)
+        self._order.append(digest)
+
+    def __len__(self):
+        return len(self._ids)
+
+    def add(self, write_id):
+        """Remember a write id, returning False if it was already seen.
+
+        Writes without an id are never treated as duplicates.
+        """
+        if write_id is None:
+            return True
+        digest = _digest(write_id)
+        if digest in self._ids:
+            return False
+        self._remember(digest)
+        self._uncommitted.append(digest)
+        return True
+
+    def commit(self, fsync=True):
+        """Persist the ids added since the last commit"""
+        if not self._uncommitted:
+            return
+        os.write(self._fd, b"".join(self._uncommitted))
+        self._records += len(self._uncommitted)
+        self._uncommitted = []
+        if fsync:
+            os.fsync(self._fd)
+
+        # Rewrite the file once it holds mostly evicted ids
+        if self._records > 2 * self.capacity:
+            self._compact()
+
+    def _compact(self):
+        tmp_path = f"{self.file_path}.tmp"
+        with open(tmp_path, "wb") as file:
+            file.write(b"".join(self._order))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, self.file_path)
+
+        os.close(self._fd)
+        self._fd = os.open(self.file_path, os.O_RDWR | os.O_APPEND)
+        self._records = len(self._order)
+
+    def close(self):
+        self.commit()
+        os.close(self._fd)
@@ -2,6 +2,9 @@ import streamlit as st
 import os
 import json
 import sys
+import time
+import threading
+from collections import deque
 import plotly.graph_objects as go
 
 # Add the src directory to the Python path so we can import the client modules
@@ -10,7 +13,18 @@ sys.path.append("/app/src")
 # Import client functions from existing scripts
 from clientWriter import send_message as client_send_message
 from clientReader import read_last_line as client_read_last_line
+from clientReader import get_replica_latencies
 from clientReader_v2 import read_all_lines as client_read_all_lines
+from replication_lag import compute_replica_lag, lag_history
+from replica_store import read_data_file, read_data_records
+from keyspaces import DEFAULT_KEYSPACE, configured_keyspaces, keyspace_dir
+from clientSubscriber import subscribe_changes
+from replication_lag import read_applied_watermark
+from versions import newer
+from clientControl import send_control
+
+# Seconds a rebuilt lag history is reused before the logs are read again
+LAG_HISTORY_TTL = 5
 
 
 # Function to read log files
@@ -28,20 +42,103 @@ def read_logs(log_file):
 
 
 # Function to read replica data files
-def read_replica_data(replica_id):
-    file_path = f"/app/replicas/replica{replica_id}/data.txt"
-    data = []
-    if os.path.exists(file_path):
-        with open(file_path, "r") as f:
-            data = [line.strip() for line in f.readlines() if line.strip()]
-    return data
+def read_replica_data(replica_id, keyspace=DEFAULT_KEYSPACE):
+    # The data file is append-only, so sort it by line number for display
+    return read_data_file(f"{keyspace_dir(replica_id, keyspace)}/data.txt")
+
+
+class LiveReplicaView:
+    """Replica contents kept up to date from the change feed.
+
+    The data files are read once when the view is created; after that every
+    applied write arrives as a change event, so the dashboard never has to
+    reread the replicas from disk. If the subscription drops, it resumes
+    from the lowest watermark seen so no event is missed.
+    """
+
+    def __init__(self, keyspace=DEFAULT_KEYSPACE, replica_ids=range(1, 4)):
+        self.keyspace = keyspace
+        self.replica_ids = list(replica_ids)
+        self.lock = threading.Lock()
+        self.lines = {}
+        self.watermarks = {}
+        self.recent_changes = deque(maxlen=100)
+        self.stop_event = threading.Event()
+
+        for replica_id in self.replica_ids:
+            replica = f"replica{replica_id}"
+            self.watermarks[replica] = read_applied_watermark(replica_id, keyspace)
+            self.lines[replica] = read_data_records(
+                f"{keyspace_dir(replica_id, keyspace)}/data.txt"
+            )
+
+        self.thread = threading.Thread(target=self._follow, daemon=True)
+        self.thread.start()
+
+    def _follow(self):
+        while not self.stop_event.is_set():
+            try:
+                subscribe_changes(
+                    self._apply,
+                    self.keyspace,
+                    since_watermark=min(self.watermarks.values()),
+                    replica_ids=self.replica_ids,
+                    stop_event=self.stop_event,
+                )
+            except Exception as e:
+                print(f"Change feed subscription failed, retrying: {e}")
+                time.sleep(2)
+
+    def _apply(self, event):
+        with self.lock:
+            replica = event["replica"]
+            if replica not in self.lines:
+                return
+            # Keep the latest version of each line, as the replicas do
+            value = (event.get("version", 0), event["content"])
+            current = self.lines[replica].get(event["line"])
+            if current is None or newer(*value, *current):
+                self.lines[replica][event["line"]] = value
+            if event["watermark"] is not None:
+                self.watermarks[replica] = max(
+                    self.watermarks[replica], event["watermark"]
+                )
+            self.recent_changes.appendleft(event)
+
+    def applied_watermarks(self):
+        """Watermark applied by each replica, as followed on the change feed"""
+        with self.lock:
+            return {
+                replica_id: self.watermarks[f"replica{replica_id}"]
+                for replica_id in self.replica_ids
+            }
+
+    def replica_data(self, replica_id):
+        with self.lock:
+            lines = self.lines.get(f"replica{replica_id}", {})
+            return [
+                f"{number} {content}" for number, (_, content) in sorted(lines.items())
+            ]
+
+    def changes(self):
+        with self.lock:
+            return list(self.recent_changes)
+
+
+# Function to get the live view of a keyspace, shared by all dashboard sessions.
+# Each view keeps a subscriber thread, so only configured keyspaces get one
+@st.cache_resource
+def get_live_view(keyspace=DEFAULT_KEYSPACE):
+    if keyspace not in configured_keyspaces():
+        raise ValueError(f"Keyspace {keyspace!r} is not configured")
+    return LiveReplicaView(keyspace)
 
 
 # Function to send write message to RabbitMQ (using clientWriter)
-def send_write_message(line_number, content):
+def send_write_message(line_number, content, keyspace=DEFAULT_KEYSPACE):
     try:
         message = f"{line_number} {content}"
-        client_send_message(message)
+        client_send_message(message, keyspace)
         return True
     except Exception as e:
         st.error(f"Failed to send message: {str(e)}")
@@ -49,9 +146,9 @@ def send_write_message(line_number, content):
 
 
 # Function to request last line (using clientReader)
-def read_last_line():
+def read_last_line(max_lag_writes=None, keyspace=DEFAULT_KEYSPACE):
     try:
-        result = client_read_last_line()
+        result = client_read_last_line(max_lag_writes=max_lag_writes, keyspace=keyspace)
         return [
             (response["replica"], response["content"])
             for response in result.get("all_responses", [])
@@ -62,12 +159,18 @@ def read_last_line():
 
 
 # Function to request all lines with majority consensus (using clientReader_v2)
-def read_all_lines():
+def read_all_lines(max_lag_writes=None, keyspace=DEFAULT_KEYSPACE):
     try:
-        results = client_read_all_lines()
+        results = client_read_all_lines(
+            max_lag_writes=max_lag_writes, keyspace=keyspace
+        )
 
         # Process results to match the expected format
-        formatted_results = {"replica_data": {}, "majority_lines": []}
+        formatted_results = {
+            "replica_data": {},
+            "majority_lines": [],
+            "repairs": results.get("repairs", {}),
+        }
 
         # Extract raw data
         for replica, lines in results.get("raw_data", {}).items():
@@ -80,7 +183,68 @@ def read_all_lines():
         return formatted_results
     except Exception as e:
         st.error(f"Failed to read all lines: {str(e)}")
-        return {"replica_data": {}, "majority_lines": []}
+        return {"replica_data": {}, "majority_lines": [], "repairs": {}}
+
+
+# Function to compute the current lag of each replica behind the writers,
+# with the applied watermarks followed on the change feed
+def read_replica_lag(keyspace=DEFAULT_KEYSPACE):
+    try:
+        applied_watermarks = get_live_view(keyspace).applied_watermarks()
+        return compute_replica_lag(
+            keyspace=keyspace, applied_watermarks=applied_watermarks
+        )
+    except Exception as e:
+        st.error(f"Failed to compute replica lag: {str(e)}")
+        return {}
+
+
+# Function to send a diagnostic command to a replica (using clientControl)
+def run_replica_command(replica_id, command, **arguments):
+    try:
+        return send_control(replica_id, command, **arguments)
+    except Exception as e:
+        st.error(f"replica{replica_id} did not answer {command}: {str(e)}")
+        return None
+
+
+# Function to rebuild the replica lag history from the operation logs, shared
+# by the reruns of every dashboard session for a few seconds
+@st.cache_data(ttl=LAG_HISTORY_TTL)
+def read_lag_history(keyspace=DEFAULT_KEYSPACE):
+    client_logs = read_logs("/app/replicas/client_operations.log")
+    replica_logs = []
+    for i in range(3):
+        replica_logs.extend(read_logs(f"/app/replicas/replica{i+1}/operations.log"))
+    return lag_history(client_logs, replica_logs, keyspace)
+
+
+def draw_replication_lag(history, metric="lag_writes"):
+    fig = go.Figure()
+
+    replicas = sorted({sample["replica"] for sample in history})
+    for replica in replicas:
+        samples = [sample for sample in history if sample["replica"] == replica]
+        fig.add_trace(
+            go.Scatter(
+                x=[sample["timestamp"] for sample in samples],
+                y=[sample[metric] for sample in samples],
+                mode="lines+markers",
+                line_shape="hv",
+                name=replica,
+            )
+        )
+
+    fig.update_layout(
+        title="Replication Lag Over Time",
+        xaxis_title="Time",
+        yaxis_title="Lag (writes)" if metric == "lag_writes" else "Lag (seconds)",
+        plot_bgcolor="rgba(0,0,0,0)",
+        paper_bgcolor="rgba(0,0,0,0)",
+        margin=dict(l=40, r=40, t=60, b=40),
+    )
+
+    return fig
 
 
 def draw_system_architecture():
@@ -6,6 +6,7 @@ import os
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 from utils.utils import *
+from keyspaces import configured_keyspaces
 
 # Set page configuration
 st.set_page_config(
@@ -20,13 +21,16 @@ st.title("Distributed Replication System Dashboard")
 # Create the sidebar
 st.sidebar.header("Control Panel")
 
+# Keyspace every operation and view below applies to
+keyspace = st.sidebar.selectbox("Keyspace", configured_keyspaces())
+
 # Write Operation Section
 st.sidebar.subheader("Write Operation")
 line_number = st.sidebar.number_input("Line Number", min_value=1, value=1)
 content = st.sidebar.text_input("Content", value="Sample text")
 
 if st.sidebar.button("Write Data"):
-    if send_write_message(line_number, content):
+    if send_write_message(line_number, content, keyspace):
         st.sidebar.success(f"Successfully wrote: {line_number} {content}")
     else:
         st.sidebar.error("Failed to write data")
@@ -34,14 +38,21 @@ if st.sidebar.button("Write Data"):
 # Read Operation Section
 st.sidebar.subheader("Read Operations")
 
+max_lag_writes = st.sidebar.number_input(
+    "Skip replicas lagging by more than (writes, 0 = never skip)",
+    min_value=0,
+    value=0,
+)
+max_lag_writes = max_lag_writes or None
+
 if st.sidebar.button("Read Last Line"):
-    with st.spinner("Reading last line from all replicas..."):
-        responses = read_last_line()
+    with st.spinner("Reading last line from the fastest replica..."):
+        responses = read_last_line(max_lag_writes, keyspace)
         st.session_state.last_read_responses = responses
 
 if st.sidebar.button("Read All Lines (Majority Consensus)"):
     with st.spinner("Reading all lines and computing majority consensus..."):
-        results = read_all_lines()
+        results = read_all_lines(max_lag_writes, keyspace)
         st.session_state.all_read_results = results
 
 # Main content area
@@ -63,11 +74,22 @@ with col2:
         st.text(f"Last content: {last_op['content']}")
         st.text(f"Time: {last_time.strftime('%H:%M:%S')}")
 
+    # Display the read latency estimates used for replica selection
+    for replica, latency in sorted(get_replica_latencies().items()):
+        st.text(f"{replica} read latency (EWMA): {latency * 1000:.0f} ms")
+
 # Results section
 st.header("Results")
 
-tab1, tab2, tab3, tab4 = st.tabs(
-    ["Last Read Results", "Consensus Results", "Replica Content", "Operation Logs"]
+tab1, tab2, tab3, tab4, tab5, tab6 = st.tabs(
+    [
+        "Last Read Results",
+        "Consensus Results",
+        "Replica Content",
+        "Replication Lag",
+        "Operation Logs",
+        "Diagnostics",
+    ]
 )
 
 with tab1:
@@ -92,6 +114,11 @@ with tab2:
         for line, count in results["majority_lines"]:
             st.success(f"{line} (found in {count}/3 replicas)")
 
+        for replica, count in results.get("repairs", {}).items():
+            st.warning(
+                f"{replica} was behind: pushed the latest version of {count} line(s)"
+            )
+
         st.subheader("Raw Data from Each Replica")
         cols = st.columns(3)
         for i, (replica, lines) in enumerate(results["replica_data"].items()):
@@ -102,21 +129,68 @@ with tab2:
     else:
         st.info("No consensus results yet. Try reading all lines from the sidebar.")
 
-with tab3:
-    # Show the content of each replica file
+
+# Refresh the replica contents from the change feed without rerunning the page
+@st.fragment(run_every=2)
+def show_replica_content():
+    live_view = get_live_view(keyspace)
+
+    # Show the content of each replica
     cols = st.columns(3)
     for i in range(3):
         replica_id = i + 1
         with cols[i]:
             st.subheader(f"Replica {replica_id}")
-            data = read_replica_data(replica_id)
+            data = live_view.replica_data(replica_id)
             if data:
                 for line in data:
                     st.text(line)
             else:
                 st.info("No data available")
 
+    # Show the latest applied writes
+    changes = live_view.changes()
+    if changes:
+        st.subheader("Recent Changes")
+        st.dataframe(
+            pd.DataFrame(changes)[
+                ["timestamp", "replica", "line", "content", "watermark"]
+            ],
+            use_container_width=True,
+        )
+
+
+with tab3:
+    show_replica_content()
+
+
+# Refresh the live lag of each replica without rerunning the page
+@st.fragment(run_every=2)
+def show_replica_lag():
+    lag = read_replica_lag(keyspace)
+    cols = st.columns(3)
+    for i, (replica, replica_lag) in enumerate(lag.items()):
+        with cols[i]:
+            st.metric(
+                f"{replica} lag",
+                f"{replica_lag['lag_writes']} writes",
+                f"{replica_lag['lag_seconds']:.1f} s",
+                delta_color="inverse",
+            )
+
+
 with tab4:
+    show_replica_lag()
+
+    # Show how the lag evolved over time
+    history = read_lag_history(keyspace)
+    if history:
+        metric = st.radio("Lag metric", ["lag_writes", "lag_seconds"], horizontal=True)
+        st.plotly_chart(draw_replication_lag(history, metric), use_container_width=True)
+    else:
+        st.info("No watermarked writes yet")
+
+with tab5:
     # Get all logs
     all_logs = []
     client_logs = read_logs("/app/replicas/client_operations.log")
@@ -148,14 +222,65 @@ with tab4:
     else:
         st.info("No operation logs available yet")
 
-# Auto-refresh the page
-st.markdown(
-    """
-    <script>
-        var timeout = setTimeout(function() {
-            window.location.reload();
-        }, 10000);
-    </script>
-    """,
-    unsafe_allow_html=True,
-)
+with tab6:
+    # Diagnose a running replica through its control queue
+    replica_id = st.selectbox("Replica", [1, 2, 3], format_func=lambda i: f"replica{i}")
+    diagnostics = st.session_state.setdefault("diagnostics", {})
+
+    cols = st.columns(5)
+    if cols[0].button("Start Profiler"):
+        response = run_replica_command(replica_id, "profile_start")
+        if response and response.get("started"):
+            st.success(f"Profiling replica{replica_id}")
+        elif response:
+            st.warning(response.get("error"))
+    if cols[1].button("Stop Profiler"):
+        diagnostics["profile"] = run_replica_command(replica_id, "profile_stop")
+    if cols[2].button("Handler Timings"):
+        diagnostics["timings"] = run_replica_command(replica_id, "timings")
+    if cols[3].button("Reset Timings"):
+        run_replica_command(replica_id, "timings", reset=True)
+        diagnostics.pop("timings", None)
+    if cols[4].button("Memory Usage"):
+        diagnostics["memory"] = run_replica_command(replica_id, "memory")
+
+    timings = diagnostics.get("timings")
+    if timings:
+        st.subheader("Handler Timings")
+        st.dataframe(
+            pd.DataFrame.from_dict(timings, orient="index"), use_container_width=True
+        )
+
+    memory = diagnostics.get("memory")
+    if memory:
+        st.subheader("Memory Usage")
+        cols = st.columns(3)
+        cols[0].metric("RSS", f"{(memory['rss_kb'] or 0) / 1024:.1f} MiB")
+        cols[1].metric("Peak RSS", f"{memory['max_rss_kb'] / 1024:.1f} MiB")
+        cols[2].metric("Python objects", memory["gc_objects"])
+        st.dataframe(
+            pd.DataFrame.from_dict(memory["keyspaces"], orient="index"),
+            use_container_width=True,
+        )
+
+    profile = diagnostics.get("profile")
+    if profile and "error" in profile:
+        st.warning(profile["error"])
+    elif profile:
+        st.subheader(
+            f"Profile ({profile['samples']} samples over {profile['duration_s']:.1f} s)"
+        )
+        cols = st.columns(2)
+        with cols[0]:
+            st.write("**Self time**")
+            st.dataframe(pd.DataFrame(profile["top_self"]), use_container_width=True)
+        with cols[1]:
+            st.write("**Including callees**")
+            st.dataframe(
+                pd.DataFrame(profile["top_inclusive"]), use_container_width=True
+            )
+        st.download_button(
+            "Download folded stacks (for flame graphs)",
+            "\n".join(profile["folded_stacks"]),
+            file_name="profile.folded",
+        )